@@ -1,15 +1,1507 @@
 import requests
 import json
+import mmap
 import os
 import logging
-from datetime import datetime
+import asyncio
+import bisect
+import codecs
+import collections
+import csv
+import functools
+import hashlib
+import inspect
+import random
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps(value):
+    """Serializes a value to UTF-8 encoded JSON, with orjson when it is installed."""
+    # Bytes, since requests would send a str body as ISO-8859-1
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def _loads(data):
+    """Parses JSON from str or bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+_JSON_STRUCTURE = re.compile(r'[][{}":]')
+_JSON_SPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _iter_json_array(chunks, key):
+    """Yields the elements of the array under key in a JSON object arriving as byte chunks, without holding the whole document in memory."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    position = 0
+    depth = 0
+    last_string = current_key = None
+    in_array = False
+
+    def more():
+        nonlocal buffer, position
+        for chunk in chunks:
+            if chunk:
+                buffer = buffer[position:] + text.decode(chunk)
+                position = 0
+                return True
+        buffer = buffer[position:] + text.decode(b'', final=True)
+        position = 0
+        return False
+
+    # Walk the top level object until the array under key opens
+    while not in_array:
+        match = _JSON_STRUCTURE.search(buffer, position)
+        if match is None:
+            position = len(buffer)
+            if not more():
+                return
+            continue
+        character = match.group()
+        if character == '"':
+            try:
+                string, end = json.decoder.scanstring(buffer, match.end())
+            except ValueError:
+                position = match.start()
+                if not more():
+                    raise
+                continue
+            if depth == 1:
+                last_string = string
+            position = end
+            continue
+        position = match.end()
+        if character in '[{':
+            depth += 1
+            in_array = character == '[' and depth == 2 and current_key == key
+        elif character in ']}':
+            depth -= 1
+            if depth == 0:
+                return
+        elif depth == 1:
+            current_key = last_string
+
+    # Decode one element at a time and only accept it once the delimiter
+    # after it has arrived, so that a number cut off at the end of a chunk
+    # is not taken as complete
+    first = True
+    while True:
+        start = _JSON_SPACE.match(buffer, position).end()
+        if start < len(buffer) and buffer[start] == ']' and first:
+            return
+        try:
+            if start == len(buffer):
+                raise ValueError('Ofullständig JSON')
+            element, end = decoder.raw_decode(buffer, start)
+            end = _JSON_SPACE.match(buffer, end).end()
+            if end == len(buffer) or buffer[end] not in ',]':
+                raise ValueError('Ofullständig eller felaktig JSON-lista')
+        except ValueError:
+            if not more():
+                raise
+            continue
+        yield element
+        first = False
+        position = end + 1
+        if buffer[end] == ']':
+            return
+
+
+@contextmanager
+def _locked_file(filename):
+    """Holds an exclusive lock on filename + '.lock' so that several processes can share a cache file."""
+    with open(filename + '.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _run_bounded(func, arguments, workers):
+    """Calls func with every argument on worker threads and yields (argument, result) pairs as they finish, queueing at most twice as many calls as workers."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for argument in arguments:
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(func, argument)] = argument
+        for future in as_completed(pending):
+            yield pending[future], future.result()
+
+
+_ID_SEGMENT = re.compile(r'^([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|\d+)$')
+
+
+def _endpoint(url):
+    """Reduces a URL to its endpoint template, e.g. /item-storage/items/{id}, so that calls to the same endpoint can be counted together."""
+    path = url.split('://', 1)[-1].split('?', 1)[0]
+    segments = path.split('/')[1:]
+    return '/' + '/'.join('{id}' if _ID_SEGMENT.match(segment) else segment
+                          for segment in segments)
+
+
+def _parse_date(value):
+    """Parses an ISO 8601 date or timestamp from FOLIO into a naive UTC datetime."""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _cql_date(value):
+    """Formats a naive UTC datetime the way FOLIO stores timestamps, for range queries."""
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + '%03d' % (value.microsecond // 1000)
+
+
+def _rewind(data):
+    """Moves a file-like request body back to its start so that it can be sent again."""
+    if hasattr(data, 'seek'):
+        data.seek(0)
+
+
+def _cql_quote(value):
+    """Quotes a value for exact matching in CQL, escaping quotes, backslashes and masking characters."""
+    for character in '\\"*?^':
+        value = value.replace(character, '\\' + character)
+    return '"' + value + '"'
+
+
+def _cql_chunks(fields, values, max_length=3000):
+    """Packs values into field==("a" or "b" ...) CQL queries that stay below max_length characters once URL encoded."""
+    if isinstance(fields, str):
+        fields = (fields,)
+
+    def build(chunk):
+        terms = ' or '.join(chunk)
+        return ' or '.join(field + '==(' + terms + ')' for field in fields)
+
+    chunk = []
+    for value in values:
+        chunk.append(_cql_quote(str(value)))
+        if len(chunk) > 1 and len(quote(build(chunk))) > max_length:
+            last = chunk.pop()
+            yield build(chunk)
+            chunk = [last]
+    if chunk:
+        yield build(chunk)
+
+
+class _UploadReader:
+    """Read-only file wrapper used to stream an upload from disk. requests reads it in small blocks, so memory use does not grow with the file, and the transfer rate is logged as it goes."""
+
+    # Seconds between progress messages
+    LOG_INTERVAL = 10
+
+    def __init__(self, fileobj, name, length=None):
+        self.fileobj = fileobj
+        self.name = name
+        self.start = fileobj.tell()
+        if length is None:
+            length = fileobj.seek(0, os.SEEK_END) - self.start
+        self.length = length
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset):
+        self.fileobj.seek(self.start + offset)
+        self.sent = 0
+        self.started = self.logged = time.time()
+
+    def read(self, size=-1):
+        remaining = self.length - self.sent
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        chunk = self.fileobj.read(size)
+        self.sent += len(chunk)
+        now = time.time()
+        if now - self.logged >= self.LOG_INTERVAL:
+            self.logged = now
+            logging.info('Laddar upp %s: %s av %s byte, %.0f byte/s',
+                         self.name, self.sent, self.length, self.rate())
+        return chunk
+
+    def rate(self):
+        return self.sent / max(time.time() - self.started, 1e-6)
+
+
+def _marc_chunks(filename, records_per_chunk=10000, bytes_per_chunk=None):
+    """Returns (start, end) byte offsets of chunks of a MARC21 file, split on record terminators, with at most records_per_chunk records (and about bytes_per_chunk bytes) each."""
+    size = os.path.getsize(filename)
+    if size == 0:
+        return []
+
+    chunks = []
+    with open(filename, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = position = 0
+        records = 0
+        while True:
+            end = data.find(b'\x1d', position)
+            if end == -1:
+                break
+            position = end + 1
+            records += 1
+            if records >= records_per_chunk or \
+                    (bytes_per_chunk and position - start >= bytes_per_chunk):
+                chunks.append((start, position))
+                start = position
+                records = 0
+
+        # Keep anything after the last full chunk, including a final record without terminator
+        if data[start:size].strip():
+            chunks.append((start, size))
+    return chunks
+
+
+class DeletePlan:
+    """Records to delete to remove a set of instances, grouped in levels that must be deleted in order. Record types within a level can be deleted in parallel."""
+
+    LEVELS = (('items',),
+              ('holdings',),
+              ('instanceRelationships', 'precedingSucceedingTitles'),
+              ('srs',),
+              ('instances',))
+
+    def __init__(self, instance_ids):
+        self.records = {record_type: set() for level in self.LEVELS
+                        for record_type in level}
+        self.records['instances'].update(instance_ids)
+
+    def levels(self):
+        """Yields a list of (record_type, ids) pairs per level, items first and instances last."""
+        for level in self.LEVELS:
+            yield [(record_type, self.records[record_type]) for record_type in level]
+
+    def summary(self):
+        return {record_type: len(ids) for record_type, ids in self.records.items()}
+
+    def __repr__(self):
+        return 'DeletePlan(%s)' % self.summary()
+
+
+class DeleteReport:
+    """Outcome of a bulk delete: ids that were deleted (204), not_found (404), blocked by a constraint (500), and failed with any other status."""
+
+    def __init__(self, record_type):
+        self.record_type = record_type
+        self.deleted = []
+        self.not_found = []
+        self.constraint = []
+        self.failed = {}
+
+    def add(self, uuid, status):
+        if status == 204:
+            self.deleted.append(uuid)
+        elif status == 404:
+            self.not_found.append(uuid)
+        elif status == 500:
+            self.constraint.append(uuid)
+        else:
+            self.failed[uuid] = status
+
+    def summary(self):
+        return {'recordType': self.record_type,
+                'deleted': len(self.deleted),
+                'notFound': len(self.not_found),
+                'constraint': len(self.constraint),
+                'failed': len(self.failed)}
+
+    def __repr__(self):
+        return 'DeleteReport(%s)' % self.summary()
+
+
+class ImportJobTracker:
+    """Follows data import jobs until they finish, polling less often while a job makes no progress, and collects what they did per record."""
+
+    TERMINAL = {'COMMITTED', 'ERROR', 'DISCARDED', 'CANCELLED'}
+
+    def __init__(self, folio, min_delay=2, max_delay=60, backoff=1.5):
+        self.folio = folio
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+
+    def status(self, jobExecutionId):
+        """Returns the job execution, including status and progress. Raises HTTPError if it can not be fetched."""
+        url = self.folio.folio_endpoint + '/change-manager/jobExecutions/' + jobExecutionId
+        response = self.folio._request('GET', url, headers=self.folio.header)
+        response.raise_for_status()
+        return _loads(response.content)
+
+    def wait(self, jobExecutionId, timeout=None):
+        """Polls a job until it has finished and returns the final job execution. Raises TimeoutError if that takes longer than timeout seconds."""
+        started = time.time()
+        delay = self.min_delay
+        last = None
+
+        while True:
+            job = self.status(jobExecutionId)
+            state = (job.get('status'), job.get('progress', {}).get('current'))
+            if state[0] in self.TERMINAL:
+                logging.info('Importjobb %s avslutat: %s', jobExecutionId, state[0])
+                return job
+            if state == last:
+                delay = min(delay * self.backoff, self.max_delay)
+            else:
+                # The job is moving again, so follow it closely
+                delay = self.min_delay
+            last = state
+            logging.debug('Importjobb %s: %s, nästa kontroll om %.0f s',
+                          jobExecutionId, state, delay)
+            if timeout is not None and time.time() + delay - started > timeout:
+                raise TimeoutError('Import job %s did not finish within %s s'
+                                   % (jobExecutionId, timeout))
+            time.sleep(delay)
+
+    @staticmethod
+    def _ids(info):
+        # Related record info is a dict or, for holdings and items in later releases, a list of dicts
+        if not info:
+            return []
+        if isinstance(info, dict):
+            info = [info]
+        ids = []
+        for entry in info:
+            ids.extend(entry.get('idList') or [])
+            if entry.get('id'):
+                ids.append(entry['id'])
+        return ids
+
+    @staticmethod
+    def _errors(entry):
+        errors = [entry['error']] if entry.get('error') else []
+        for key in ('relatedInstanceInfo', 'relatedHoldingsInfo', 'relatedItemInfo'):
+            info = entry.get(key) or []
+            for related in [info] if isinstance(info, dict) else info:
+                if related.get('error'):
+                    errors.append(related['error'])
+        return errors
+
+    def records(self, jobExecutionId, page_size=1000):
+        """Yields one dict per incoming record of a job with its order in the file, title, SRS record id, the ids of the instances, holdings and items it created or updated, and any errors."""
+        entries = self.folio.iterData('/metadata-provider/jobLogEntries/' + jobExecutionId,
+                                      None, 'entries', page_size)
+        for entry in entries:
+            yield {'order': entry.get('sourceRecordOrder'),
+                   'title': entry.get('sourceRecordTitle'),
+                   'action': entry.get('sourceRecordActionStatus'),
+                   'srsId': entry.get('sourceRecordId'),
+                   'instanceIds': self._ids(entry.get('relatedInstanceInfo')),
+                   'holdingsIds': self._ids(entry.get('relatedHoldingsInfo')),
+                   'itemIds': self._ids(entry.get('relatedItemInfo')),
+                   'errors': self._errors(entry)}
+
+    def result(self, jobExecutionId, timeout=None):
+        """Waits for a job and returns its final job execution, the per-record results and the records that failed."""
+        job = self.wait(jobExecutionId, timeout)
+        records = list(self.records(jobExecutionId))
+        failed = [record for record in records if record['errors']]
+        if failed:
+            logging.error('Importjobb %s: %s av %s poster misslyckades.',
+                          jobExecutionId, len(failed), len(records))
+        return {'jobExecution': job, 'records': records, 'failed': failed}
+
+
+class BatchReport:
+    """Outcome of a batch load. committed counts the records that were stored and failed lists (record, status code, message) for every record that was rejected or sent when the server failed."""
+
+    def __init__(self, record_type):
+        self.record_type = record_type
+        self.committed = 0
+        self.requests = 0
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def add(self, committed=0, failed=()):
+        with self._lock:
+            self.requests += 1
+            self.committed += committed
+            self.failed.extend(failed)
+
+    def summary(self):
+        return {'recordType': self.record_type,
+                'committed': self.committed,
+                'failed': len(self.failed),
+                'requests': self.requests}
+
+    def __repr__(self):
+        return 'BatchReport(%s)' % self.summary()
+
+
+class PatronImportReport:
+    """Outcome of importPatrons: created, updated, failed and skipped patrons, and (externalSystemId, message) for every failure."""
 
-class FolioCommunication:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.skipped = 0
+        self.chunks = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add(self, result, users):
+        """Adds the response of one chunk, or its status code if the whole chunk failed. Returns the external system ids of the users that failed."""
+        with self._lock:
+            self.chunks += 1
+            if not isinstance(result, dict):
+                self.failed += len(users)
+                self.errors.extend((user.get('externalSystemId'), 'Status %s' % result)
+                                   for user in users)
+                return {user.get('externalSystemId') for user in users}
+            self.created += result.get('createdRecords', 0)
+            self.updated += result.get('updatedRecords', 0)
+            self.failed += result.get('failedRecords', 0)
+            failed_users = result.get('failedUsers', [])
+            self.errors.extend((user.get('externalSystemId'), user.get('errorMessage'))
+                               for user in failed_users)
+            return {user.get('externalSystemId') for user in failed_users} | \
+                set(result.get('failedExternalSystemIds', []))
+
+    def summary(self):
+        return {'created': self.created,
+                'updated': self.updated,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'chunks': self.chunks}
+
+    def __repr__(self):
+        return 'PatronImportReport(%s)' % self.summary()
+
+
+class PermissionSyncReport:
+    """Outcome of syncPermissions: user ids that were unchanged, created, updated or failed, and the permissions added and removed per user."""
+
+    def __init__(self):
+        self.unchanged = []
+        self.created = []
+        self.updated = []
+        self.failed = {}
+        self.changes = {}
+
+    def summary(self):
+        return {'unchanged': len(self.unchanged),
+                'created': len(self.created),
+                'updated': len(self.updated),
+                'failed': len(self.failed)}
+
+    def __repr__(self):
+        return 'PermissionSyncReport(%s)' % self.summary()
+
+
+class PinReport:
+    """Outcome of setPINs: user ids whose PIN was set, replaced or kept, and (step, status code) for those that failed. PINs are never stored."""
 
     def __init__(self):
+        self.set = []
+        self.replaced = []
+        self.kept = []
+        self.failed = {}
+
+    def summary(self):
+        return {'set': len(self.set),
+                'replaced': len(self.replaced),
+                'kept': len(self.kept),
+                'failed': len(self.failed)}
+
+    def __repr__(self):
+        return 'PinReport(%s)' % self.summary()
+
+
+class RetryPolicy:
+    """Decides when _request retries a request: which statuses and methods, how many attempts, and how long to wait, with jittered backoff or Retry-After."""
+
+    IDEMPOTENT = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+    def __init__(self, max_attempts=4, statuses=(429, 502, 503, 504), backoff=0.5,
+                 max_backoff=30, max_retry_after=300, retry_all_methods=False):
+        self.max_attempts = max_attempts
+        self.statuses = set(statuses)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.retry_all_methods = retry_all_methods
+
+    def allows(self, method, attempt, retry=None):
+        """Tells whether attempt number attempt (counted from 1) of a call may be followed by another one. retry overrides the idempotency check for a single call."""
+        if attempt >= self.max_attempts:
+            return False
+        if retry is not None:
+            return retry
+        return self.retry_all_methods or method.upper() in self.IDEMPOTENT
+
+    def delay(self, attempt, response=None):
+        """Returns the number of seconds to wait before the next attempt."""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = (parsedate_to_datetime(retry_after) -
+                               datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    seconds = None
+            if seconds is not None:
+                return min(max(seconds, 0), self.max_retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class ConcurrencyController:
+    """Limits requests in flight per endpoint family with additive increase and multiplicative decrease, and optionally the request rate for the tenant."""
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, decrease=0.5,
+                 latency_target=5.0, rate=None, burst=1):
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.rate = rate
+        self.burst = burst
+        self._families = {}
+        self._condition = threading.Condition()
+        self._rate_lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def acquire(self, family):
+        """Waits for a free slot in the family, and for the rate limit, and returns the start time to pass to release."""
+        with self._condition:
+            state = self._families.setdefault(
+                family, {'limit': float(self.initial), 'inflight': 0, 'decreased': 0.0})
+            while state['inflight'] >= int(state['limit']):
+                self._condition.wait()
+            state['inflight'] += 1
+        if self.rate:
+            self._pace()
+        return time.monotonic()
+
+    def _pace(self):
+        # Token bucket where a negative balance is the wait owed by the caller
+        with self._rate_lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def release(self, family, started, overloaded):
+        """Frees the slot taken by acquire and adjusts the family's limit. overloaded tells whether the server answered with an error that signals overload."""
+        now = time.monotonic()
+        with self._condition:
+            state = self._families[family]
+            state['inflight'] -= 1
+            if overloaded or now - started > self.latency_target:
+                # Requests started before the last decrease saw the old limit, so they do not count again
+                if started > state['decreased']:
+                    state['limit'] = max(self.min_limit, state['limit'] * self.decrease)
+                    state['decreased'] = now
+                    logging.info('Sänker samtidiga anrop mot %s till %s.',
+                                 family, int(state['limit']))
+            else:
+                state['limit'] = min(self.max_limit, state['limit'] + 1 / state['limit'])
+            self._condition.notify_all()
+
+    def limits(self):
+        """Returns the current limit and number of requests in flight per endpoint family."""
+        with self._condition:
+            return {family: {'limit': int(state['limit']), 'inflight': state['inflight']}
+                    for family, state in self._families.items()}
+
+
+class _LogPayload:
+    """Log argument that renders a payload, bounded, redacted and sampled, only when the message is actually emitted."""
+
+    SECRET_KEYS = {'password', 'pin', 'token', 'okapitoken', 'x-okapi-token',
+                   'accesstoken', 'refreshtoken'}
+    SECRET_TEXT = re.compile(
+        r'("(?:password|pin|token|okapiToken|accessToken|refreshToken)"\s*:\s*")[^"]*'
+        r'|eyJ[\w-]+\.[\w-]+\.[\w-]*', re.IGNORECASE)
+
+    def __init__(self, value, limit=1000, sample=1.0):
+        self.value = value
+        self.limit = limit
+        self.sample = sample
+
+    def __str__(self):
+        if self.sample < 1 and random.random() >= self.sample:
+            return '<utelämnad>'
+        pieces = []
+        self._budget = self.limit
+        self._render(self.value, pieces)
+        text = ''.join(pieces)
+        if self._budget < 0:
+            text = text[:self.limit] + '…'
+        return text
+
+    def _emit(self, pieces, text):
+        pieces.append(text)
+        self._budget -= len(text)
+
+    def _render(self, value, pieces):
+        if isinstance(value, dict):
+            self._emit(pieces, '{')
+            for index, (key, item) in enumerate(value.items()):
+                if self._budget <= 0:
+                    self._emit(pieces, '…')
+                    break
+                self._emit(pieces, (', ' if index else '') + repr(key) + ': ')
+                if str(key).lower() in self.SECRET_KEYS:
+                    self._emit(pieces, "'***'")
+                else:
+                    self._render(item, pieces)
+            self._emit(pieces, '}')
+        elif isinstance(value, (list, tuple)):
+            self._emit(pieces, '[')
+            for index, item in enumerate(value):
+                if self._budget <= 0:
+                    self._emit(pieces, '… %s till' % (len(value) - index))
+                    break
+                if index:
+                    self._emit(pieces, ', ')
+                self._render(item, pieces)
+            self._emit(pieces, ']')
+        elif isinstance(value, (bytes, bytearray, str)):
+            if isinstance(value, (bytes, bytearray)):
+                value = bytes(value[:max(self._budget, 0) + 1]).decode('utf-8', 'replace')
+            else:
+                value = value[:max(self._budget, 0) + 1]
+            self._emit(pieces, self.SECRET_TEXT.sub(
+                lambda match: (match.group(1) or '') + '***', value))
+        else:
+            self._emit(pieces, repr(value))
+
+
+def _body_size(body):
+    """Returns the size in bytes of a request body, or 0 if it can not be told without reading it."""
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode())
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+class Metrics:
+    """Counts, statuses, errors, retries, bytes and latency percentiles per method and endpoint template, with optional hooks around every request."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.before_request = []
+        self.after_request = []
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._dumper = None
+        self._stop = threading.Event()
+
+    def _entry(self, method, endpoint):
+        key = (method, endpoint)
+        entry = self._endpoints.get(key)
+        if entry is None:
+            entry = self._endpoints[key] = {
+                'count': 0, 'statuses': collections.Counter(), 'errors': collections.Counter(),
+                'retries': 0, 'bytesSent': 0, 'bytesReceived': 0,
+                'buckets': [0] * (len(self.BUCKETS) + 1), 'latencySum': 0.0, 'latencyMax': 0.0}
+        return entry
+
+    def record(self, method, endpoint, elapsed, sent, received, status=None, error=None):
+        with self._lock:
+            entry = self._entry(method, endpoint)
+            entry['count'] += 1
+            entry['bytesSent'] += sent
+            entry['bytesReceived'] += received
+            entry['buckets'][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+            entry['latencySum'] += elapsed
+            entry['latencyMax'] = max(entry['latencyMax'], elapsed)
+            if status is not None:
+                entry['statuses'][status] += 1
+                if status >= 400:
+                    entry['errors']['HTTP %s' % status] += 1
+            if error is not None:
+                entry['errors'][error.__class__.__name__] += 1
+
+    def recordRetry(self, method, endpoint):
+        with self._lock:
+            self._entry(method, endpoint)['retries'] += 1
+
+    def _percentile(self, entry, fraction):
+        # Linear interpolation within the histogram bucket holding the percentile
+        rank = fraction * entry['count']
+        seen = 0
+        lower = 0.0
+        for index, count in enumerate(entry['buckets']):
+            upper = self.BUCKETS[index] if index < len(self.BUCKETS) else entry['latencyMax']
+            if count and seen + count >= rank:
+                return min(lower + (upper - lower) * (rank - seen) / count, entry['latencyMax'])
+            seen += count
+            lower = upper
+        return entry['latencyMax']
+
+    def snapshot(self):
+        """Returns the numbers collected so far as a dict keyed by 'METHOD /endpoint/template'."""
+        with self._lock:
+            return {method + ' ' + endpoint: {
+                'count': entry['count'],
+                'statuses': dict(entry['statuses']),
+                'errors': dict(entry['errors']),
+                'retries': entry['retries'],
+                'bytesSent': entry['bytesSent'],
+                'bytesReceived': entry['bytesReceived'],
+                'latency': {'mean': entry['latencySum'] / entry['count'] if entry['count'] else 0.0,
+                            'p50': self._percentile(entry, 0.50),
+                            'p95': self._percentile(entry, 0.95),
+                            'p99': self._percentile(entry, 0.99),
+                            'max': entry['latencyMax']}}
+                for (method, endpoint), entry in sorted(self._endpoints.items())}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def toJSON(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def toPrometheus(self):
+        """Returns the numbers collected so far in the Prometheus text exposition format."""
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def labels(method, endpoint, **extra):
+            pairs = [('method', method), ('endpoint', endpoint)] + list(extra.items())
+            return '{' + ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs) + '}'
+
+        families = collections.OrderedDict((name, ['# TYPE %s %s' % (name, kind)]) for name, kind in (
+            ('folio_requests_total', 'counter'),
+            ('folio_request_errors_total', 'counter'),
+            ('folio_request_retries_total', 'counter'),
+            ('folio_request_bytes_total', 'counter'),
+            ('folio_request_duration_seconds', 'histogram')))
+
+        def add(family, sample, value, **extra):
+            families[family].append(sample + labels(method, endpoint, **extra) + ' %s' % value)
+
+        with self._lock:
+            for (method, endpoint), entry in sorted(self._endpoints.items()):
+                add('folio_requests_total', 'folio_requests_total', entry['count'])
+                for error, count in sorted(entry['errors'].items()):
+                    add('folio_request_errors_total', 'folio_request_errors_total', count, error=error)
+                add('folio_request_retries_total', 'folio_request_retries_total', entry['retries'])
+                add('folio_request_bytes_total', 'folio_request_bytes_total', entry['bytesSent'],
+                    direction='sent')
+                add('folio_request_bytes_total', 'folio_request_bytes_total', entry['bytesReceived'],
+                    direction='received')
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), entry['buckets']):
+                    cumulative += count
+                    add('folio_request_duration_seconds', 'folio_request_duration_seconds_bucket',
+                        cumulative, le=bound)
+                add('folio_request_duration_seconds', 'folio_request_duration_seconds_sum',
+                    entry['latencySum'])
+                add('folio_request_duration_seconds', 'folio_request_duration_seconds_count',
+                    entry['count'])
+
+        lines = [line for family in families.values() for line in family]
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename, format='json'):
+        """Writes the numbers collected so far to filename as JSON or, with format='prometheus', in the Prometheus text format."""
+        text = self.toPrometheus() if format == 'prometheus' else self.toJSON()
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(text)
+        os.replace(temporary, filename)
+
+    def startDump(self, filename, interval=60, format='json'):
+        """Writes the numbers to filename every interval seconds from a background thread until stopDump is called."""
+        self.stopDump()
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.dump(filename, format)
+            self.dump(filename, format)
+
+        self._dumper = threading.Thread(target=run, name='folio-metrics', daemon=True)
+        self._dumper.start()
+
+    def stopDump(self):
+        if self._dumper is not None:
+            self._stop.set()
+            self._dumper.join()
+            self._dumper = None
+
+
+class AuthenticationError(Exception):
+    """Raised when Folio does not hand out an okapi token. response is the login response, or None."""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+        self.status_code = getattr(response, 'status_code', None)
+
+
+class TokenManager:
+    """Keeps the okapi token, logging in lazily and again when it expires or is rejected. A cache_file shares the token between processes."""
+
+    # Seconds before the expiry time when a token is no longer handed out
+    EXPIRY_MARGIN = 30
+
+    def __init__(self, folio, cache_file=None, ttl=None, login_path='/authn/login'):
+        self.folio = folio
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.login_path = login_path
+        self._token = None
+        self._expires = None
+        self._lock = threading.Lock()
+
+    def _valid(self, token, expires):
+        return bool(token) and (expires is None or
+                                time.time() < expires - self.EXPIRY_MARGIN)
+
+    def get(self):
+        """Returns a usable token, logging in if there is none yet."""
+        with self._lock:
+            if not self._valid(self._token, self._expires):
+                self._token, self._expires = self._acquire(self._token)
+            return self._token
+
+    def refresh(self, rejected=None):
+        """Replaces the token after it has been rejected. If another thread or process has already replaced the rejected token the new one is returned without logging in."""
+        with self._lock:
+            if rejected is not None and self._token != rejected and \
+                    self._valid(self._token, self._expires):
+                return self._token
+            self._token, self._expires = self._acquire(rejected or self._token)
+            return self._token
+
+    def _acquire(self, stale):
+        if self.cache_file is None:
+            return self._login()
+
+        with _locked_file(self.cache_file):
+            cached = self._readCache()
+            if cached and cached['token'] != stale and \
+                    self._valid(cached['token'], cached['expires']):
+                logging.info('Använder okapi token från %s', self.cache_file)
+                return cached['token'], cached['expires']
+            token, expires = self._login()
+            self._writeCache(token, expires)
+            return token, expires
+
+    def _cacheKey(self):
+        return [self.folio.folio_endpoint, self.folio.okapi_tenant, self.folio.username]
+
+    def _readCache(self):
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('key') != self._cacheKey():
+            return None
+        return cached
+
+    def _writeCache(self, token, expires):
+        # The token is a credential, so the file is only readable by the owner
+        temporary = self.cache_file + '.tmp'
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'key': self._cacheKey(), 'token': token,
+                       'expires': expires}, f)
+        os.replace(temporary, self.cache_file)
+
+    def _login(self):
+        logging.info('Loggar in mot %s', self.login_path)
+        folio = self.folio
+        # Logging in again is safe, so transient failures are retried
+        response = folio._request('POST', folio.folio_endpoint + self.login_path,
+                                  retry=True, authenticate=False,
+                                  data=_dumps(folio.payload), headers=folio.header)
+        if not response.ok:
+            raise AuthenticationError('Login failed with status %s' % response.status_code,
+                                      response)
+
+        token = response.headers.get('x-okapi-token') or \
+            response.cookies.get('folioAccessToken')
+        if not token:
+            raise AuthenticationError('No okapi token in login response', response)
+
+        expires = None
+        try:
+            expiration = _loads(response.content).get('accessTokenExpiration')
+        except ValueError:
+            expiration = None
+        if expiration:
+            expires = datetime.fromisoformat(
+                expiration.replace('Z', '+00:00')).timestamp()
+        elif self.ttl:
+            expires = time.time() + self.ttl
+        return token, expires
+
+
+class ReferenceData:
+    """Reference tables such as locations and material types, looked up by id, name or code, cached for ttl seconds and optionally on disk."""
+
+    # name: (path, record key, name field, code field)
+    TABLES = {
+        'locations': ('/locations', 'locations', 'name', 'code'),
+        'materialTypes': ('/material-types', 'mtypes', 'name', 'code'),
+        'loanTypes': ('/loan-types', 'loantypes', 'name', None),
+        'groups': ('/groups', 'usergroups', 'group', None),
+        'addressTypes': ('/addresstypes', 'addressTypes', 'addressType', None),
+        'callNumberTypes': ('/call-number-types', 'callNumberTypes', 'name', None),
+        'servicePoints': ('/service-points', 'servicepoints', 'name', 'code'),
+    }
+
+    def __init__(self, folio, ttl=3600, cache_file=None):
+        self.folio = folio
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, loaded):
+        return self.ttl is None or time.time() - loaded < self.ttl
+
+    def _index(self, table, records, loaded):
+        path, key, name_field, code_field = self.TABLES[table]
+        entry = {'loaded': loaded, 'records': records,
+                 'id': {r['id']: r for r in records},
+                 'name': {r[name_field]: r for r in records if name_field in r},
+                 'code': {}}
+        if code_field:
+            entry['code'] = {r[code_field]: r for r in records if code_field in r}
+        self._tables[table] = entry
+        return entry
+
+    def _entry(self, table):
+        if table not in self.TABLES:
+            raise KeyError('Unknown reference table: ' + table)
+        with self._lock:
+            entry = self._tables.get(table)
+            if entry is not None and self._fresh(entry['loaded']):
+                return entry
+
+            cached = self._readCache().get(table)
+            if cached is not None and self._fresh(cached['loaded']):
+                return self._index(table, cached['records'], cached['loaded'])
+
+            path, key, name_field, code_field = self.TABLES[table]
+            logging.info('Laddar referensdata: %s', table)
+            records = list(self.folio.iterData(path, key=key, page_size=1000))
+            entry = self._index(table, records, time.time())
+            self._writeCache(table, records, entry['loaded'])
+            return entry
+
+    def _readCache(self):
+        if self.cache_file is None:
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _writeCache(self, table, records, loaded):
+        if self.cache_file is None:
+            return
+        with _locked_file(self.cache_file):
+            cached = self._readCache()
+            cached[table] = {'loaded': loaded, 'records': records}
+            temporary = self.cache_file + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(cached, f)
+            os.replace(temporary, self.cache_file)
+
+    def records(self, table):
+        """Returns all records in a reference table."""
+        return self._entry(table)['records']
+
+    def byId(self, table, uuid):
+        """Returns the record with the given UUID, or None."""
+        return self._entry(table)['id'].get(uuid)
+
+    def byName(self, table, name):
+        """Returns the record with the given name, or None."""
+        return self._entry(table)['name'].get(name)
+
+    def byCode(self, table, code):
+        """Returns the record with the given code, or None."""
+        return self._entry(table)['code'].get(code)
+
+    def uuid(self, table, name_or_code):
+        """Returns the UUID of the record with the given name or code, or None."""
+        entry = self._entry(table)
+        record = entry['name'].get(name_or_code) or entry['code'].get(name_or_code)
+        return record['id'] if record else None
+
+    def invalidate(self, table=None):
+        """Forgets one table, or all tables, both in memory and on disk."""
+        with self._lock:
+            tables = [table] if table else list(self.TABLES)
+            for name in tables:
+                self._tables.pop(name, None)
+            if self.cache_file is not None and os.path.exists(self.cache_file):
+                with _locked_file(self.cache_file):
+                    cached = self._readCache()
+                    for name in tables:
+                        cached.pop(name, None)
+                    with open(self.cache_file, 'w') as f:
+                        json.dump(cached, f)
+
+
+class UserCache:
+    """LRU cache of users by UUID, username, barcode, externalSystemId and permission user id, with entries expiring after ttl seconds."""
+
+    # Fields a user can be looked up by besides its UUID
+    KEYS = ('username', 'barcode', 'externalSystemId')
+
+    def __init__(self, folio, max_size=10000, ttl=3600):
+        self.folio = folio
+        self.max_size = max_size
+        self.ttl = ttl
+        # uuid: (loaded, user), least recently used first
+        self._users = collections.OrderedDict()
+        # (field, value): uuid
+        self._index = {}
+        # user uuid: (loaded, permission user id), and the other way around
+        self._permissions = collections.OrderedDict()
+        self._permissionUsers = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, loaded):
+        return self.ttl is None or time.time() - loaded < self.ttl
+
+    def _forget(self, uuid):
+        loaded, user = self._users.pop(uuid, (None, None))
+        if user is not None:
+            for field in self.KEYS:
+                if self._index.get((field, user.get(field))) == uuid:
+                    del self._index[(field, user.get(field))]
+        loaded, permissions_id = self._permissions.pop(uuid, (None, None))
+        self._permissionUsers.pop(permissions_id, None)
+
+    def add(self, user):
+        """Stores or replaces a user record in the cache."""
+        with self._lock:
+            uuid = user['id']
+            self._forget(uuid)
+            self._users[uuid] = (time.time(), user)
+            for field in self.KEYS:
+                if user.get(field):
+                    self._index[(field, user[field])] = uuid
+            while len(self._users) > self.max_size:
+                self._forget(next(iter(self._users)))
+
+    def _cached(self, uuid):
+        with self._lock:
+            loaded, user = self._users.get(uuid, (None, None))
+            if user is None or not self._fresh(loaded):
+                return None
+            self._users.move_to_end(uuid)
+            return user
+
+    def user(self, field, value):
+        """Returns the user whose field (id, username, barcode or externalSystemId) equals value, or None. Raises HTTPError if the user can not be fetched."""
+        uuid = value if field == 'id' else self._index.get((field, value))
+        user = self._cached(uuid) if uuid else None
+        if user is not None:
+            return user
+        url = self.folio.folio_endpoint + '/users'
+        response = self.folio._request('GET', url, headers=self.folio.header,
+                                       params={'query': field + '==' + _cql_quote(value),
+                                               'limit': 2})
+        response.raise_for_status()
+        users = _loads(response.content).get('users', [])
+        if len(users) > 1:
+            logging.warning('Fler än en användare har %s %s', field, value)
+        for user in users:
+            self.add(user)
+        return users[0] if users else None
+
+    def uuid(self, field, value):
+        """Returns the UUID of the user whose field equals value, or None."""
+        user = self.user(field, value)
+        return user['id'] if user else None
+
+    def permissionsId(self, uuid):
+        """Returns the id of the permission user belonging to a user UUID, or None."""
+        with self._lock:
+            loaded, permissions_id = self._permissions.get(uuid, (None, None))
+            if permissions_id is not None and self._fresh(loaded):
+                self._permissions.move_to_end(uuid)
+                return permissions_id
+        url = self.folio.folio_endpoint + '/perms/users'
+        response = self.folio._request('GET', url, headers=self.folio.header,
+                                       params={'query': 'userId==' + _cql_quote(uuid)})
+        response.raise_for_status()
+        permission_users = _loads(response.content).get('permissionUsers', [])
+        if not permission_users:
+            return None
+        permissions_id = permission_users[0]['id']
+        with self._lock:
+            self._permissions[uuid] = (time.time(), permissions_id)
+            self._permissionUsers[permissions_id] = uuid
+            while len(self._permissions) > self.max_size:
+                evicted, (loaded, evicted_id) = self._permissions.popitem(last=False)
+                self._permissionUsers.pop(evicted_id, None)
+        return permissions_id
+
+    def userIdForPermissions(self, permissions_id):
+        """Returns the user UUID of a cached permission user id, or None."""
+        return self._permissionUsers.get(permissions_id)
+
+    def warm(self, query='cql.allRecords=1', page_size=1000):
+        """Loads every user matching a CQL query into the cache with paged requests. Returns the number of users loaded."""
+        count = 0
+        for user in self.folio.iterData('/users', query, 'users', page_size):
+            self.add(user)
+            count += 1
+        logging.info('Laddade %s användare i cachen', count)
+        return count
+
+    def invalidate(self, uuid=None, **keys):
+        """Forgets one user, given by UUID or by a field such as username=..., or every user if nothing is given."""
+        with self._lock:
+            if uuid is None and not keys:
+                self._users.clear()
+                self._index.clear()
+                self._permissions.clear()
+                self._permissionUsers.clear()
+                return
+            for field, value in keys.items():
+                uuid = uuid or self._index.get((field, value))
+                self._index.pop((field, value), None)
+            if uuid is not None:
+                self._forget(uuid)
+
+
+class ChangeSync:
+    """Reads records changed since the last sync, using metadata.updatedDate as a high-water mark per collection. Records near the mark may be yielded again."""
+
+    # name: (path, record key)
+    COLLECTIONS = {
+        'instances': ('/instance-storage/instances', 'instances'),
+        'holdings': ('/holdings-storage/holdings', 'holdingsRecords'),
+        'items': ('/item-storage/items', 'items'),
+        'loans': ('/circulation/loans', 'loans'),
+    }
+
+    def __init__(self, folio, state_file=None, overlap=300):
+        self.folio = folio
+        self.state_file = state_file
+        self.overlap = overlap
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def _readState(self):
+        if self.state_file is None:
+            return self._state
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _writeState(self, collection, watermark):
+        with self._lock:
+            if self.state_file is None:
+                self._state[collection] = {'watermark': watermark, 'synced': time.time()}
+                return
+            with _locked_file(self.state_file):
+                state = self._readState()
+                state[collection] = {'watermark': watermark, 'synced': time.time()}
+                temporary = self.state_file + '.tmp'
+                with open(temporary, 'w') as f:
+                    json.dump(state, f)
+                os.replace(temporary, self.state_file)
+
+    def watermark(self, collection):
+        """Returns the updatedDate of the newest record synced from a collection, or None."""
+        return self._readState().get(collection, {}).get('watermark')
+
+    def reset(self, collection, watermark=None):
+        """Sets the mark of a collection, so that the next sync starts from watermark, or from the beginning if it is None."""
+        self._writeState(collection, watermark)
+
+    def changes(self, collection, query=None, page_size=1000):
+        """Yields the records changed since the last sync, oldest first, storing the mark after every page. Raises HTTPError if a page can not be fetched."""
+        if collection not in self.COLLECTIONS:
+            raise KeyError('Unknown collection: ' + collection)
+        path, key = self.COLLECTIONS[collection]
+        url = self.folio.folio_endpoint + path
+        watermark = self.watermark(collection)
+        lower = None
+        if watermark is not None:
+            start = _parse_date(watermark) - timedelta(seconds=self.overlap)
+            lower = '>="%s"' % _cql_date(start)
+        logging.info('Synkar ändringar i %s sedan %s', collection, watermark)
+        # Ids already yielded that have the same updatedDate as the lower bound
+        tied = set()
+        count = 0
+
+        while True:
+            clauses = [query] if query else []
+            if lower:
+                clauses.append('metadata.updatedDate' + lower)
+            cql = ' and '.join('(%s)' % clause for clause in clauses) or 'cql.allRecords=1'
+            response = self.folio._request('GET', url, headers=self.folio.header,
+                                           params={'query': cql + ' sortBy metadata.updatedDate',
+                                                   'limit': page_size})
+            response.raise_for_status()
+            records = _loads(response.content).get(key, [])
+            for record in records:
+                if record['id'] not in tied:
+                    count += 1
+                    yield record
+            if not records:
+                break
+
+            last = records[-1]['metadata']['updatedDate']
+            if len(records) < page_size:
+                self._writeState(collection, last)
+                break
+            if records[0]['metadata']['updatedDate'] == last:
+                # A whole page changed at the same moment, so step past it
+                # with offset paging on that exact timestamp
+                tied.update(record['id'] for record in records)
+                same = '(%s) and ' % query if query else ''
+                for record in self.folio.iterData(path, same + 'metadata.updatedDate=="%s"' % last,
+                                                  key, page_size):
+                    if record['id'] not in tied:
+                        count += 1
+                        yield record
+                lower = '>"%s"' % last
+                tied = set()
+            else:
+                lower = '>="%s"' % last
+                tied = {record['id'] for record in records
+                        if record['metadata']['updatedDate'] == last}
+            self._writeState(collection, last)
+
+        logging.info('Synkade %s ändrade poster i %s', count, collection)
+
+
+class _MirrorSync(ChangeSync):
+    """ChangeSync that keeps its marks in the mirror database, committed together with the records they cover."""
+
+    def __init__(self, folio, connection, overlap):
+        super().__init__(folio, None, overlap)
+        self.connection = connection
+
+    def _readState(self):
+        rows = self.connection.execute('SELECT collection, watermark, synced FROM sync_state')
+        return {collection: {'watermark': watermark, 'synced': synced}
+                for collection, watermark, synced in rows}
+
+    def _writeState(self, collection, watermark):
+        self.connection.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                                (collection, watermark, time.time()))
+        self.connection.commit()
+
+
+class InventoryMirror:
+    """Local SQLite copy of instances, holdings and items, stored as JSON with indexed columns, refreshed incrementally and queried offline."""
+
+    # table: {column: path to the value in the record}
+    TABLES = {
+        'instances': {
+            'hrid': ('hrid',),
+            'title': ('title',),
+            'source': ('source',),
+            'updatedDate': ('metadata', 'updatedDate'),
+        },
+        'holdings': {
+            'hrid': ('hrid',),
+            'instanceId': ('instanceId',),
+            'permanentLocationId': ('permanentLocationId',),
+            'effectiveLocationId': ('effectiveLocationId',),
+            'callNumber': ('callNumber',),
+            'updatedDate': ('metadata', 'updatedDate'),
+        },
+        'items': {
+            'hrid': ('hrid',),
+            'barcode': ('barcode',),
+            'holdingsRecordId': ('holdingsRecordId',),
+            'effectiveLocationId': ('effectiveLocationId',),
+            'materialTypeId': ('materialTypeId',),
+            'status': ('status', 'name'),
+            'updatedDate': ('metadata', 'updatedDate'),
+        },
+    }
+
+    def __init__(self, folio, filename, overlap=300):
+        self.folio = folio
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self._createSchema()
+        self.sync = _MirrorSync(folio, self.connection, overlap)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes the database."""
+        self.connection.close()
+
+    def _createSchema(self):
+        self.connection.execute('CREATE TABLE IF NOT EXISTS sync_state '
+                                '(collection TEXT PRIMARY KEY, watermark TEXT, synced REAL)')
+        for table, columns in self.TABLES.items():
+            self.connection.execute('CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, %s, json TEXT NOT NULL)'
+                                    % (table, ', '.join(column + ' TEXT' for column in columns)))
+            for column in columns:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                                        % (table, column, table, column))
+        self.connection.commit()
+
+    def _table(self, table):
+        if table not in self.TABLES:
+            raise KeyError('Unknown mirror table: ' + table)
+        return self.TABLES[table]
+
+    @staticmethod
+    def _value(record, path):
+        for key in path:
+            if not isinstance(record, dict):
+                return None
+            record = record.get(key)
+        return record
+
+    def refresh(self, tables=None, page_size=1000):
+        """Fetches the records changed since the last refresh into the given tables, or all tables. The first refresh of a table loads all of it. Returns the number of records written per table."""
+        counts = {}
+        for table in tables or self.TABLES:
+            columns = self._table(table)
+            statement = 'INSERT OR REPLACE INTO %s (id, %s, json) VALUES (?, %s?)' % (
+                table, ', '.join(columns), '?, ' * len(columns))
+            count = 0
+            for record in self.sync.changes(table, page_size=page_size):
+                self.connection.execute(statement, [record['id']]
+                                        + [self._value(record, path) for path in columns.values()]
+                                        + [_dumps(record).decode('utf-8')])
+                count += 1
+            self.connection.commit()
+            logging.info('Spegeln uppdaterade %s poster i %s', count, table)
+            counts[table] = count
+        return counts
+
+    def load(self, tables=None, page_size=1000):
+        """Empties the given tables, or all tables, and loads them again from Folio. Use this to drop records that have been deleted in Folio."""
+        tables = tables or list(self.TABLES)
+        for table in tables:
+            self._table(table)
+            self.connection.execute('DELETE FROM %s' % table)
+            self.connection.execute('DELETE FROM sync_state WHERE collection = ?', (table,))
+        self.connection.commit()
+        return self.refresh(tables, page_size)
+
+    def get(self, table, uuid):
+        """Returns the record with the given UUID, or None."""
+        self._table(table)
+        row = self.connection.execute('SELECT json FROM %s WHERE id = ?' % table, (uuid,)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def query(self, table, where=None, params=(), order_by=None, limit=None):
+        """Yields the records in a table matching an SQL where clause, e.g. query('items', 'barcode = ?', [barcode]). The indexed columns and json_extract(json, '$.field') can be used in where and order_by."""
+        self._table(table)
+        statement = 'SELECT json FROM %s' % table
+        if where:
+            statement += ' WHERE ' + where
+        if order_by:
+            statement += ' ORDER BY ' + order_by
+        if limit is not None:
+            statement += ' LIMIT %d' % limit
+        for row in self.connection.execute(statement, params):
+            yield _loads(row[0])
+
+    def count(self, table, where=None, params=()):
+        """Returns the number of records in a table matching an SQL where clause."""
+        self._table(table)
+        statement = 'SELECT count(*) FROM %s' % table
+        if where:
+            statement += ' WHERE ' + where
+        return self.connection.execute(statement, params).fetchone()[0]
+
+    def execute(self, statement, params=()):
+        """Runs any SQL statement against the mirror and returns the rows, for joins and aggregates."""
+        return self.connection.execute(statement, params).fetchall()
+
+
+class FolioCommunication:
+
+    # Record types accepted by bulkDelete and the method deleting one record of each
+    DELETE_METHODS = {
+        'instances': 'deleteInstance',
+        'holdings': 'deleteHoldingsRecord',
+        'items': 'deleteItem',
+        'srs': 'deleteSRSRecord',
+        'instanceRelationships': 'deleteInstanceRelationships',
+        'precedingSucceedingTitles': 'deletePrecedingSucceedingTitle',
+    }
+
+    # Record types accepted by lookup: (path, record key)
+    LOOKUP_TYPES = {
+        'instances': ('/instance-storage/instances', 'instances'),
+        'holdings': ('/holdings-storage/holdings', 'holdingsRecords'),
+        'items': ('/item-storage/items', 'items'),
+        'users': ('/users', 'users'),
+    }
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True, timeout=(10, 300), token_cache=None, token_ttl=None,
+                 reference_ttl=3600, reference_cache=None, retry_policy=None,
+                 concurrency=None, metrics=None, log_limit=1000, log_sample=1.0,
+                 sync_state=None, user_cache_size=10000, user_ttl=3600):
+        """Opens a pooled session against Folio. The options for tokens, caches, retries, concurrency, metrics and logging are described in README.md."""
 
         # Initialize environment variables
         load_dotenv()
@@ -20,34 +1512,186 @@ class FolioCommunication:
         self.payload = {'username': self.username,
                         'password': self.password}
 
-        # Define generic header without okapi token
-        self.header = {'Accept': 'application/json',
-                       'Content-Type': 'application/json',
-                       'x-okapi-tenant': self.okapi_tenant}
-
-        # Fetch okapi token
-        self.okapi_token = self.getToken()
-
-        # Add okapi token to header
-        self.header['x-okapi-token'] = self.okapi_token
+        # Read-only header profiles without okapi token, which is added per request
+        self.headers = {
+            'json': MappingProxyType({'Accept': 'application/json',
+                                      'Content-Type': 'application/json',
+                                      'x-okapi-tenant': self.okapi_tenant}),
+            'text': MappingProxyType({'Accept': 'text/plain',
+                                      'Content-Type': 'application/json',
+                                      'x-okapi-tenant': self.okapi_tenant}),
+            'octet': MappingProxyType({'Accept': 'application/json',
+                                       'Content-Type': 'application/octet-stream',
+                                       'x-okapi-tenant': self.okapi_tenant}),
+        }
+        self.header = self.headers['json']
+        self._prepared = (None, {})
+
+        # Shared connection pool used by every method
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+        # Retries of transient failures, shared by all methods
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+
+        # Optional adaptive limit on requests in flight
+        self.concurrency = concurrency
+
+        # Per-endpoint counts, latencies, bytes and errors
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # Size and sampling of payloads written to the log
+        self.log_limit = log_limit
+        self.log_sample = log_sample
+
+        # The okapi token is fetched lazily and added to the header of every request
+        self.tokens = TokenManager(
+            self, token_cache or os.environ.get('FOLIO_TOKEN_CACHE'), token_ttl)
+
+        # Follows data import jobs started by processFile
+        self.jobs = ImportJobTracker(self)
+
+        # Cached locations, material types, loan types, groups etc.
+        self.reference = ReferenceData(self, reference_ttl, reference_cache)
+
+        # Users by UUID, username, barcode and permission user id
+        self.users = UserCache(self, user_cache_size, user_ttl)
+
+        # High-water marks for incremental reads of changed records
+        self.sync = ChangeSync(self, sync_state)
+
+    @property
+    def okapi_token(self):
+        return self.tokens.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes the pooled connections held by the session and stops any periodic metrics dump."""
+        self.metrics.stopDump()
+        self.session.close()
+
+    def _logged(self, value):
+        """Wraps a response or payload for a log message so that it is only rendered, bounded and redacted, if the message is emitted."""
+        return _LogPayload(value, self.log_limit, self.log_sample)
+
+    def _request(self, method, url, retry=None, authenticate=True, **kwargs):
+        """Sends a request with the default timeout, retrying transient failures according to self.retry_policy. retry=True or False overrides the policy."""
+        kwargs.setdefault('timeout', self.timeout)
+        policy = self.retry_policy
+        attempt = 1
+
+        while True:
+            try:
+                if authenticate:
+                    response = self._sendWithToken(method, url, **kwargs)
+                else:
+                    response = self._send(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                if not policy.allows(method, attempt, retry):
+                    raise
+                reason, wait = err.__class__.__name__, policy.delay(attempt)
+            else:
+                if response.status_code not in policy.statuses or \
+                        not policy.allows(method, attempt, retry):
+                    return response
+                reason, wait = response.status_code, policy.delay(attempt, response)
+                # Hands the connection back to the pool, which a streamed response would otherwise keep
+                response.close()
+
+            endpoint = _endpoint(url)
+            self.metrics.recordRetry(method, endpoint)
+            logging.warning('%s %s misslyckades (%s), försök %s av %s om %.1f s.',
+                            method, endpoint, reason, attempt + 1, policy.max_attempts, wait)
+            _rewind(kwargs.get('data'))
+            time.sleep(wait)
+            attempt += 1
+
+    def _send(self, method, url, **kwargs):
+        """Sends one HTTP exchange, within the limits of self.concurrency if there is one, and records it in self.metrics."""
+        metrics = self.metrics
+        endpoint = _endpoint(url)
+        for hook in metrics.before_request:
+            hook(method, url, kwargs)
+
+        if self.concurrency is not None:
+            family = endpoint.split('/')[1]
+            slot = self.concurrency.acquire(family)
+        started = time.monotonic()
+        response = error = None
+        try:
+            response = self.session.request(method, url, **kwargs)
+            return response
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            if self.concurrency is not None:
+                # Timeouts and dropped connections count as overload as well
+                overloaded = response is None or response.status_code >= 500 or \
+                    response.status_code == 429
+                self.concurrency.release(family, slot, overloaded)
+
+            status = received = None
+            if response is not None:
+                status = response.status_code
+                received = response.headers.get('Content-Length')
+                received = int(received) if received else \
+                    (0 if kwargs.get('stream') else len(response.content))
+            metrics.record(method, endpoint, elapsed, _body_size(kwargs.get('data')),
+                           received or 0, status, error)
+            for hook in metrics.after_request:
+                hook(method, url, response, elapsed, error)
+
+    def _prepareHeaders(self, headers, token):
+        """Returns headers with the okapi token added. For the shared header profiles the result is built once per token and reused."""
+        prepared_token, prepared = self._prepared
+        if prepared_token != token:
+            prepared = {id(profile): dict(profile, **{'x-okapi-token': token})
+                        for profile in self.headers.values()}
+            self._prepared = (token, prepared)
+        if id(headers) in prepared:
+            return prepared[id(headers)]
+        return dict(headers, **{'x-okapi-token': token})
+
+    def _sendWithToken(self, method, url, **kwargs):
+        """Sends a request with the current okapi token. If the token is rejected with 401 it is refreshed and the request sent once more."""
+        base = kwargs.pop('headers', None) or self.header
+        token = self.tokens.get()
+        response = self._send(method, url, headers=self._prepareHeaders(base, token), **kwargs)
+
+        if response.status_code == 401:
+            logging.info('Okapi token avvisades, loggar in igen.')
+            response.close()
+            token = self.tokens.refresh(token)
+            _rewind(kwargs.get('data'))
+            response = self._send(method, url, headers=self._prepareHeaders(base, token), **kwargs)
+        return response
 
     def getToken(self):
-        """Method for acquiring OKAPI token."""
+        """Method for acquiring OKAPI token. Always logs in again and hands the new token to the token manager."""
         okapiToken = ''
         logging.info('Hämtar okapi token.')
-        path = '/authn/login'
-        url = self.folio_endpoint + path
 
         try:
-            response = requests.post(url, data=json.dumps(
-                self.payload), headers=self.header)
-            response.raise_for_status()
-            okapiToken = response.headers['x-okapi-token']
-            logging.info('Hämtade okapi token: %s', okapiToken)
+            okapiToken = self.tokens.refresh()
+            logging.info('Hämtade okapi token.')
             return okapiToken
-        except HTTPError as http_err:
-            logging.error(f'HTTP error occurred: {http_err}')
-            return response.status_code
+        except AuthenticationError as auth_err:
+            logging.error(f'Login failed: {auth_err}')
+            return auth_err.status_code
         except Exception as err:
             logging.error(f'Other error occurred: {err}')
             return None
@@ -58,10 +1702,10 @@ class FolioCommunication:
         payload = {'fileDefinitions': [{'name': filename}]}
 
         try:
-            response = requests.post(
-                url, data=json.dumps(payload), headers=self.header)
+            response = self._request('POST',
+                url, data=_dumps(payload), headers=self.header)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -71,18 +1715,24 @@ class FolioCommunication:
             return None
 
     def uploadFile(self, uploadDefinitionId, fileDefinitionId, data):
+        """Uploads the contents of a file definition. data can be bytes, a file name or an open binary file; files are streamed from disk in blocks instead of being read into memory."""
         path = '/data-import/uploadDefinitions/' + \
             uploadDefinitionId + '/files/' + fileDefinitionId
         url = self.folio_endpoint + path
 
-        header = {'Content-Type': 'application/octet-stream',
-                  'x-okapi-tenant': self.okapi_tenant,
-                  'X-Okapi-Token': self.okapi_token}
+        opened = None
+        if isinstance(data, (str, os.PathLike)):
+            data = opened = open(data, 'rb')
+        if hasattr(data, 'read') and not isinstance(data, _UploadReader):
+            data = _UploadReader(data, getattr(data, 'name', fileDefinitionId))
 
         try:
-            response = requests.post(url, data=data, headers=header)
+            response = self._request('POST', url, data=data, headers=self.headers['octet'])
             response.raise_for_status()
-            response_json = response.json()
+            if isinstance(data, _UploadReader):
+                logging.info('Laddade upp %s: %s byte, %.0f byte/s',
+                             data.name, data.sent, data.rate())
+            response_json = _loads(response.content)
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -90,6 +1740,9 @@ class FolioCommunication:
         except Exception as err:
             logging.error(f'Other error occurred: {err}')
             return None
+        finally:
+            if opened is not None:
+                opened.close()
 
     def processFile(self, uploadDefinitionId, data):
         path = '/data-import/uploadDefinitions/' + \
@@ -97,8 +1750,8 @@ class FolioCommunication:
         url = self.folio_endpoint + path
 
         try:
-            response = requests.post(
-                url, data=json.dumps(data), headers=self.header)
+            response = self._request('POST',
+                url, data=_dumps(data), headers=self.header)
             return response
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -107,20 +1760,90 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def importMarcFile(self, filename, jobProfileInfo, wait=False):
+        """Imports a MARC file with the given job profile. Returns the response from processFile, or with wait the result of the finished job."""
+        response, jobExecutionId = self._importMarc(
+            os.path.basename(filename), filename, jobProfileInfo)
+        return self._importResult(response, jobExecutionId, wait)
+
+    def _importMarc(self, name, data, jobProfileInfo):
+        """Runs the upload and processing stages. Returns the processFile response and the job execution id, or None for both if an earlier stage failed."""
+        logging.info('Importerar %s', name)
+
+        definition = self.uploadDefinitions(name)
+        if not isinstance(definition, dict):
+            logging.error('Kunde inte skapa uppladdningsdefinition för %s', name)
+            return None, None
+        uploadDefinitionId = definition['id']
+        fileDefinitionId = definition['fileDefinitions'][0]['id']
+
+        uploadDefinition = self.uploadFile(uploadDefinitionId, fileDefinitionId, data)
+        if not isinstance(uploadDefinition, dict):
+            logging.error('Kunde inte ladda upp %s', name)
+            return None, None
+
+        response = self.processFile(uploadDefinitionId,
+                                    {'uploadDefinition': uploadDefinition,
+                                     'jobProfileInfo': jobProfileInfo})
+        return response, uploadDefinition['fileDefinitions'][0].get('jobExecutionId')
+
+    def _importResult(self, response, jobExecutionId, wait):
+        if not wait or jobExecutionId is None or \
+                not isinstance(response, requests.Response) or not response.ok:
+            return response
+        return self.jobs.result(jobExecutionId)
+
+    def importMarcDirectory(self, directory, jobProfileInfo, suffix='.mrc'):
+        """Runs importMarcFile for every non-empty file in directory whose name ends with suffix. Returns a dict from file name to the result of importMarcFile."""
+        results = {}
+        for filename in sorted(os.listdir(directory)):
+            filepath = os.path.join(directory, filename)
+            if filename.endswith(suffix) and os.stat(filepath).st_size != 0:
+                results[filename] = self.importMarcFile(filepath, jobProfileInfo)
+        return results
+
+    def importMarcFileParallel(self, filename, jobProfileInfo, records_per_job=10000,
+                               bytes_per_job=None, max_jobs=4, wait=False):
+        """Imports a MARC file as jobs of at most records_per_job records, with at most max_jobs jobs running. Returns (chunk name, response, or with wait the job result) in file order."""
+        chunks = _marc_chunks(filename, records_per_job, bytes_per_job)
+        base, extension = os.path.splitext(os.path.basename(filename))
+        logging.info('Delar upp %s i %s importjobb.', filename, len(chunks))
+
+        def chunkName(number):
+            return '%s_%04d%s' % (base, number, extension)
+
+        def submit(numbered):
+            number, (start, end) = numbered
+            with open(filename, 'rb') as f:
+                f.seek(start)
+                response, jobExecutionId = self._importMarc(
+                    chunkName(number), _UploadReader(f, chunkName(number), end - start),
+                    jobProfileInfo)
+            if wait:
+                return self._importResult(response, jobExecutionId, wait)
+            if jobExecutionId is not None and \
+                    isinstance(response, requests.Response) and response.ok:
+                # Hold the slot until the job has finished, so that at most max_jobs run
+                self.jobs.wait(jobExecutionId)
+            return response
+
+        results = sorted(_run_bounded(submit, enumerate(chunks, 1), max_jobs),
+                         key=lambda pair: pair[0][0])
+        return [(chunkName(number), result) for (number, offsets), result in results]
+
     def getMappingRules(self, filename):
         """Method for getting mapping rules, i.e., how MARC21 elements are mapped to internal data. Returns JSON converted to Python dictionary."""
         path = '/mapping-rules'
         url = self.folio_endpoint + path
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header)
+            response = self._request('GET', url, headers=self.header)
             response.raise_for_status()
-            response_json = response.json()
-            response_json_obejct = json.dumps(response_json)
+            response_json = _loads(response.content)
+            response_json_obejct = _dumps(response_json).decode('utf-8')
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
-            with open(filename, "w") as outfile:
+            logging.info('Hittade: %s', self._logged(response_json))
+            with open(filename, "w", encoding="utf-8") as outfile:
                 outfile.write(response_json_obejct)
             return response_json
         except HTTPError as http_err:
@@ -136,8 +1859,8 @@ class FolioCommunication:
         url = self.folio_endpoint + path
 
         try:
-            response = requests.put(
-                url, data=json.dumps(mapping_rules), headers=self.header)
+            response = self._request('PUT',
+                url, data=_dumps(mapping_rules), headers=self.header)
             return response
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -152,7 +1875,7 @@ class FolioCommunication:
         url = self.folio_endpoint + path
 
         try:
-            response = requests.put(
+            response = self._request('PUT',
                 url, headers=self.header)
             return response
         except HTTPError as http_err:
@@ -166,18 +1889,17 @@ class FolioCommunication:
     def getInstance(self, instanceId):
         """Retrieves a specific instance."""
         logging.info(
-            'Söker instans: ' + instanceId)
+            'Söker instans: %s', instanceId)
         path = '/instance-storage/instances/' + instanceId
         #path = '/inventory/instances/' + instanceId
         url = self.folio_endpoint + path
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header)
+            response = self._request('GET', url, headers=self.header)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -189,7 +1911,7 @@ class FolioCommunication:
     def getInstances(self, query_string, limit=10):
         """Retrieves instances matching a CQL query string. An optional parameter can be passed to limit how many matches are returned."""
         logging.info(
-            'Söker instanser med med följande söksträng: ' + query_string)
+            'Söker instanser med med följande söksträng: %s', query_string)
         # path = '/inventory/instances'
         path = '/instance-storage/instances'
         url = self.folio_endpoint + path
@@ -200,12 +1922,11 @@ class FolioCommunication:
         # 'limit': 10}
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -214,19 +1935,23 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def iterInstances(self, query_string='cql.allRecords=1', page_size=100):
+        """Yields every instance matching a CQL query string, one record at a time."""
+        return self.iterData('/instance-storage/instances', query_string,
+                             'instances', page_size)
+
     def deleteInstance(self, instance_to_delete):
         """Method for deleting instances. Takes a UUID as input. Returns response code. 500 usually means that the instance can not be deleted due to internal constraints being violated."""
-        logging.info('Försöker ta bort följande instans: ' +
+        logging.info('Försöker ta bort följande instans: %s',
                      instance_to_delete)
         # path = '/inventory/instances/' + instance_to_delete
         path = '/instance-storage/instances/' + instance_to_delete
         url = self.folio_endpoint + path
 
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=self.header)
+            response = self._request('DELETE', url, headers=self.header)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response.content)
+            logging.info('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -243,12 +1968,11 @@ class FolioCommunication:
         param = {'limit': limit}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -258,19 +1982,15 @@ class FolioCommunication:
             return None
 
     def deleteInstanceRelationships(self, instance_to_delete):
-        logging.info('Försöker ta bort instance relationship: ' +
+        logging.info('Försöker ta bort instance relationship: %s',
                      instance_to_delete)
         path = '/instance-storage/instance-relationships/' + instance_to_delete
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=local_header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.debug('Systemet säger %s', response.content)
+            logging.debug('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -287,12 +2007,11 @@ class FolioCommunication:
         param = {'limit': limit, 'deleted': deleted}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -302,18 +2021,17 @@ class FolioCommunication:
             return None
 
     def getSRSRecordId(self, instance_uuid):
-        logging.info('Hämtar SRS uuid för instans: ' +
+        logging.info('Hämtar SRS uuid för instans: %s',
                      instance_uuid)
         path = '/source-storage/records/' + instance_uuid + '/formatted?idType=INSTANCE'
         url = self.folio_endpoint + path
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header)
+            response = self._request('GET', url, headers=self.header)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.debug('Systemet säger %s', response.content)
+            logging.debug('Systemet säger %s', self._logged(response.content))
             return response_json['id']
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -323,7 +2041,7 @@ class FolioCommunication:
             return None
 
     def deleteSRSRecord(self, instance_to_delete):
-        logging.info('Försöker ta bort source record: ' +
+        logging.info('Försöker ta bort source record: %s',
                      instance_to_delete)
         # path = '/inventory/instances/' + instance_to_delete
         # path = '/instance-storage/instances/' + \
@@ -332,14 +2050,10 @@ class FolioCommunication:
         #path = '/instance-storage/instances/' + instance_to_delete + "/source-record"
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=local_header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.debug('Systemet säger %s', response.content)
+            logging.debug('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -353,14 +2067,10 @@ class FolioCommunication:
         path = '/loan-storage/loans'
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=local_header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.debug('Systemet säger %s', response.content)
+            logging.debug('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -374,14 +2084,10 @@ class FolioCommunication:
         path = '/request-storage/requests'
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=local_header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.debug('Systemet säger %s', response.content)
+            logging.debug('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -397,12 +2103,11 @@ class FolioCommunication:
         param = {'limit': limit}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -416,14 +2121,10 @@ class FolioCommunication:
         path = '/audit-data/circulation/logs'
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=local_header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.debug('Systemet säger %s', response.content)
+            logging.debug('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -437,7 +2138,7 @@ class FolioCommunication:
     def getItems(self, query_string, limit=10):
         """Retrieves items matching a CQL query string. An optional parameter can be passed to limit how many matches are returned."""
         logging.info(
-            'Söker items med med följande söksträng: ' + query_string)
+            'Söker items med med följande söksträng: %s', query_string)
         #path = '/inventory/items'
         path = '/item-storage/items'
         url = self.folio_endpoint + path
@@ -448,12 +2149,11 @@ class FolioCommunication:
         # 'limit': 10}
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -462,20 +2162,21 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def iterItems(self, query_string='cql.allRecords=1', page_size=100):
+        """Yields every item matching a CQL query string, one record at a time."""
+        return self.iterData('/item-storage/items', query_string,
+                             'items', page_size)
+
     def deleteItem(self, uuid):
-        logging.info('Försöker ta bort följande item: ' +
+        logging.info('Försöker ta bort följande item: %s',
                      uuid)
         path = '/item-storage/items/' + uuid
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=local_header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response.content)
+            logging.info('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -490,8 +2191,8 @@ class FolioCommunication:
         url = self.folio_endpoint + path
 
         try:
-            response = requests.put(
-                url, data=json.dumps(itemData), headers=self.header)
+            response = self._request('PUT',
+                url, data=_dumps(itemData), headers=self.header)
             return response
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -500,6 +2201,104 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def patronToImportUser(self, user_dict, patron_group, address_type):
+        """Maps a patron in the same form as createUser takes to the /user-import schema. patron_group and address_type are names, not UUIDs."""
+        return {'username': user_dict['id'],
+                'externalSystemId': user_dict['id'],
+                'barcode': user_dict['id'],
+                'patronGroup': patron_group,
+                'active': True,
+                'personal': {
+                    'firstName': user_dict['name'],
+                    'middleName': user_dict['co1'],
+                    'lastName': user_dict['co2'],
+                    'email': user_dict['email'],
+                    'preferredContactTypeId': 'email',
+                    'addresses': [{
+                        'countryId': 'SE',
+                        'addressLine1': user_dict['street_address'],
+                        'addressLine2': user_dict['po_box'],
+                        'city': user_dict['city'],
+                        'postalCode': user_dict['postal_code'],
+                        'addressTypeId': address_type,
+                        'primaryAddress': True
+                    }]
+                }}
+
+    @staticmethod
+    def _readPatrons(source):
+        """Yields patrons from an iterable, a CSV file or a file with one JSON object per line."""
+        if not isinstance(source, str):
+            yield from source
+            return
+        with open(source, newline='', encoding='utf-8') as f:
+            if source.lower().endswith('.csv'):
+                yield from csv.DictReader(f)
+            else:
+                for line in f:
+                    if line.strip():
+                        yield _loads(line)
+
+    def importPatrons(self, patrons, mapper=None, chunk_size=500, workers=2,
+                      state_file=None, update_only_present_fields=False, source_type=None):
+        """Imports patrons from an iterable or a CSV/JSON lines file through /user-import in concurrent chunks, skipping unchanged ones. Returns a PatronImportReport."""
+        report = PatronImportReport()
+        previous = {}
+        if state_file is not None:
+            try:
+                with open(state_file) as f:
+                    previous = json.load(f)
+            except (OSError, ValueError):
+                previous = {}
+        state = dict(previous)
+
+        def fingerprint(user):
+            return hashlib.sha1(json.dumps(user, sort_keys=True).encode()).hexdigest()
+
+        def chunks():
+            chunk = []
+            for patron in self._readPatrons(patrons):
+                user = mapper(patron) if mapper else patron
+                key = user.get('externalSystemId') or user.get('username')
+                digest = fingerprint(user)
+                if previous.get(key) == digest:
+                    report.skipped += 1
+                    continue
+                chunk.append((key, digest, user))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        def send(chunk):
+            payload = {'users': [user for key, digest, user in chunk],
+                       'totalRecords': len(chunk),
+                       'deactivateMissingUsers': False,
+                       'updateOnlyPresentFields': update_only_present_fields}
+            if source_type:
+                payload['sourceType'] = source_type
+            return self.importUsers(payload)
+
+        logging.info('Importerar låntagare i delar om %s', chunk_size)
+        try:
+            for chunk, result in _run_bounded(send, chunks(), workers):
+                failed = report.add(result, [user for key, digest, user in chunk])
+                for key, digest, user in chunk:
+                    if user.get('externalSystemId') not in failed:
+                        state[key] = digest
+                logging.info('Låntagarimport: %s', report)
+        finally:
+            if state_file is not None and state != previous:
+                with _locked_file(state_file):
+                    temporary = state_file + '.tmp'
+                    with open(temporary, 'w') as f:
+                        json.dump(state, f)
+                    os.replace(temporary, state_file)
+
+        logging.info('Låntagarimport klar: %s', report)
+        return report
+
     def getLocations(self):
                 
         path = '/locations'
@@ -508,12 +2307,11 @@ class FolioCommunication:
         param = {'limit': 300}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -530,12 +2328,11 @@ class FolioCommunication:
         param = {'limit': limit}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -544,7 +2341,10 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
-
+    def iterLoans(self, query_string='cql.allRecords=1', page_size=100):
+        """Yields every loan matching a CQL query string, one record at a time."""
+        return self.iterData('/circulation/loans', query_string,
+                             'loans', page_size)
 
     def getHolds(self, query):
         
@@ -554,12 +2354,11 @@ class FolioCommunication:
         param = {'query': query, 'limit': 500}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -575,10 +2374,10 @@ class FolioCommunication:
         payload = {'destinationItemId': itemId, 'requestType': requestType }
 
         try:
-            response = requests.post(
-                url, data=json.dumps(payload), headers=self.header)
+            response = self._request('POST',
+                url, data=_dumps(payload), headers=self.header)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -594,12 +2393,11 @@ class FolioCommunication:
         param = {'query': query, 'limit': limit}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -608,15 +2406,68 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def iterData(self, path, query='cql.allRecords=1', key=None, page_size=100, sort_by='id', stream=False):
+        """Pages through a collection and yields its records one at a time. key is guessed from the first page if not given. Raises HTTPError if a page fails."""
+        logging.info('Bläddrar igenom %s med följande söksträng: %s', path, query)
+        url = self.folio_endpoint + path
+        if query and sort_by and 'sortby' not in query.lower():
+            query = query + ' sortBy ' + sort_by
+        offset = 0
+
+        while True:
+            param = {'limit': page_size, 'offset': offset}
+            if query:
+                param['query'] = query
+            if stream and key is not None:
+                count = 0
+                for record in self.streamData(path, key, param):
+                    count += 1
+                    yield record
+            else:
+                response = self._request('GET', url, headers=self.header, params=param)
+                response.raise_for_status()
+                page = _loads(response.content)
+                if key is None:
+                    key = next((k for k, v in page.items() if isinstance(v, list)), None)
+                    if key is None:
+                        return
+                records = page.get(key, [])
+                yield from records
+                count = len(records)
+            logging.debug('Hämtade %s poster från offset %s', count, offset)
+            if count < page_size:
+                return
+            offset += count
+
+    def streamData(self, path, key, params=None):
+        """Yields the records in the list named key while a large response is still arriving. Raises HTTPError if the request fails."""
+        url = self.folio_endpoint + path
+        response = self._request('GET', url, headers=self.header, params=params, stream=True)
+        try:
+            response.raise_for_status()
+            yield from _iter_json_array(response.iter_content(65536), key)
+        finally:
+            response.close()
+
+    def iterSourceRecords(self, page_size=1000):
+        """Yields every source record (MARC and its parsed form) one at a time. Source storage does not take CQL, so the records come in storage order."""
+        return self.iterData('/source-storage/source-records', None,
+                             'sourceRecords', page_size, sort_by=None, stream=True)
+
+    def iterRequests(self, query_string='cql.allRecords=1', page_size=100):
+        """Yields every circulation request (holds, pages and recalls) matching a CQL query string, one record at a time."""
+        return self.iterData('/circulation/requests', query_string,
+                             'requests', page_size)
+
     def postData(self, path, payload):
         
         url = self.folio_endpoint + path
         
         try:
-            response = requests.post(
+            response = self._request('POST',
                 url, data=payload, headers=self.header)
             response.raise_for_status()
-            # response_json = response.json()
+            # response_json = _loads(response.content)
             return response
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -628,15 +2479,13 @@ class FolioCommunication:
     def putUserData(self, path, payload):
         
         url = self.folio_endpoint + path
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
 
         
         try:
-            response = requests.put(
-                url, data=payload, headers=local_header)
+            response = self._request('PUT',
+                url, data=payload, headers=self.headers['text'])
             response.raise_for_status()
-            # response_json = response.json()
+            # response_json = _loads(response.content)
             return response
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -654,12 +2503,11 @@ class FolioCommunication:
         param = {'limit': 20}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -675,12 +2523,11 @@ class FolioCommunication:
         param = {'limit': limit}
         
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s',  response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -691,19 +2538,15 @@ class FolioCommunication:
 
 
     def deletePrecedingSucceedingTitle(self, precedingSucceedingTitleId):
-        logging.info('Försöker ta bort följande precedingSucceeding titel: ' +
+        logging.info('Försöker ta bort följande precedingSucceeding titel: %s',
                      precedingSucceedingTitleId)
         path = '/preceding-succeeding-titles/' + precedingSucceedingTitleId
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=self.header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response.content)
+            logging.info('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -718,12 +2561,11 @@ class FolioCommunication:
         param = {'limit': 100}
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -739,12 +2581,11 @@ class FolioCommunication:
         param = {'limit': 200}
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -755,23 +2596,17 @@ class FolioCommunication:
 
 
     def userExists(self, username):
-        path = '/users?limit=1&query=(username=$' + username + ')'
-        url = self.folio_endpoint + path
-
+        """Returns {'users': [user], 'totalRecords': 1} if a user with the username exists, otherwise False. Looks in self.users first."""
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header)
-            response.raise_for_status()
-            response_json = response.json()
-            logging.info('Systemet säger %s', response.status_code)
-            logging.info('Resultat: %s', response_json)
-            if response_json['totalRecords'] > 0:
-                return response_json
+            user = self.users.user('username', username)
+            logging.info('Resultat: %s', self._logged(user))
+            if user is not None:
+                return {'users': [user], 'totalRecords': 1}
             else:
                 return False
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
-            return response.status_code
+            return http_err.response.status_code
         except Exception as err:
             logging.error(f'Other error occurred: {err}')
             return None
@@ -790,12 +2625,11 @@ class FolioCommunication:
         param = {'limit': 100}
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -805,20 +2639,19 @@ class FolioCommunication:
             return None
 
     def getAddressTypeUUID(self, address_types, address_type):
-        result = None
-
+        """Finds the UUID of an address type in the result of getAddressTypes. Use self.reference.uuid('addressTypes', name) for repeated lookups."""
         for item in address_types['addressTypes']:
             if item['addressType'] == address_type:
-                result = item['id']
+                return item['id']
 
-        return result
+        return None
 
     def runAgedToLost(self):
         path = "/circulation/scheduled-age-to-lost"
         url = self.folio_endpoint + path
 
         try:
-            response = requests.post(url, headers=self.header)
+            response = self._request('POST', url, headers=self.header)
             response.raise_for_status()
 
             logging.info('Systemet säger %s', response.status_code)
@@ -836,7 +2669,7 @@ class FolioCommunication:
         url = self.folio_endpoint + path
 
         try:
-            response = requests.post(url, headers=self.header)
+            response = self._request('POST', url, headers=self.header)
             response.raise_for_status()
 
             logging.info('Systemet säger %s', response.status_code)
@@ -861,13 +2694,13 @@ class FolioCommunication:
         # CheckOut:
 
         try:
-            response = requests.post(
-                url, data=json.dumps(payload), headers=self.header)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('POST',
+                url, data=_dumps(payload), headers=self.header)
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
+            logging.info('Systemet säger %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -885,13 +2718,13 @@ class FolioCommunication:
                    "userBarcode": userBarcode}
 
         try:
-            response = requests.post(
-                url, data=json.dumps(payload), headers=self.header)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('POST',
+                url, data=_dumps(payload), headers=self.header)
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
+            logging.info('Systemet säger %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -901,38 +2734,84 @@ class FolioCommunication:
             return None
 
     def getLoansByDueDate(self, dueDateFrom, dueDateTo):
-        path = '/circulation/loans?limit=1000&query=(dueDate>="' + dueDateFrom + \
-            '" and dueDate<="' + dueDateTo + '" and status.name==Open)'
-        url = self.folio_endpoint + path
-        #param = {'query':(status.name == 'Open'),'limit': 1000}
-
+        """Returns every open loan due between dueDateFrom and dueDateTo as {'loans': [...], 'totalRecords': n}. Uses iterLoansByDueDate, so busy periods with more than 1000 loans are fetched in full."""
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header)
-            response.raise_for_status()
-            response_json = response.json()
-            logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
-            return response_json
+            loans = list(self.iterLoansByDueDate(dueDateFrom, dueDateTo))
+            logging.info('Hittade %s lån med förfallodatum %s - %s',
+                         len(loans), dueDateFrom, dueDateTo)
+            return {'loans': loans, 'totalRecords': len(loans)}
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
-            return response.status_code
+            return http_err.response.status_code
         except Exception as err:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def iterLoansByDueDate(self, dueDateFrom, dueDateTo, limit=1000, workers=4):
+        """Yields every open loan due between dueDateFrom and dueDateTo once, splitting the window until each part fits in one request."""
+        start = _parse_date(dueDateFrom)
+        end = _parse_date(dueDateTo)
+        seen = set()
+        windows = [(start, end, '>="' + dueDateFrom + '"', '<="' + dueDateTo + '"')]
+
+        def fetch(window):
+            query = '(dueDate%s and dueDate%s and status.name==Open)' % window[2:]
+            response = self._request('GET', self.folio_endpoint + '/circulation/loans',
+                                     headers=self.header,
+                                     params={'query': query, 'limit': limit})
+            response.raise_for_status()
+            page = _loads(response.content)
+            return page.get('totalRecords', 0), page.get('loans', [])
+
+        while windows:
+            pending = []
+            for window, (total, loans) in _run_bounded(fetch, windows, workers):
+                # totalRecords may be an estimate, so a full page is
+                # treated as a window with more loans than it returned
+                if total > len(loans) or len(loans) >= limit:
+                    pending.append((window, max(total, len(loans) + 1)))
+                    continue
+                for loan in loans:
+                    if loan['id'] not in seen:
+                        seen.add(loan['id'])
+                        yield loan
+
+            windows = []
+            for (first, last, lower, upper), total in pending:
+                if last - first < timedelta(seconds=1):
+                    # Too many loans due at the same moment to split further
+                    logging.info('Bläddrar igenom %s lån med förfallodatum %s - %s',
+                                 total, first, last)
+                    query = 'dueDate%s and dueDate%s and status.name==Open' % (lower, upper)
+                    for loan in self.iterData('/circulation/loans', query, 'loans', limit):
+                        if loan['id'] not in seen:
+                            seen.add(loan['id'])
+                            yield loan
+                    continue
+                # Cut the window into parts that should hold about limit / 2
+                # loans each if they are spread evenly, with each boundary
+                # belonging to the later part
+                parts = min(-(-2 * total // limit), 64)
+                step = (last - first) / parts
+                bounds = [first + step * i for i in range(1, parts)]
+                logging.debug('Delar förfallodatum %s - %s (%s lån) i %s delar',
+                              first, last, total, parts)
+                lowers = [lower] + ['>="%s"' % _cql_date(bound) for bound in bounds]
+                uppers = ['<"%s"' % _cql_date(bound) for bound in bounds] + [upper]
+                edges = [first] + bounds + [last]
+                windows.extend(zip(edges, edges[1:], lowers, uppers))
+
     def getGroups(self):
         path = '/groups'
         url = self.folio_endpoint + path
         param = {'limit': 100}
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -974,13 +2853,15 @@ class FolioCommunication:
         }
 
         try:
-            response = requests.post(
-                url, data=json.dumps(payload), headers=self.header)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('POST',
+                url, data=_dumps(payload), headers=self.header)
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
+            logging.info('Systemet säger %s', self._logged(response_json))
+            self.users.invalidate(username=payload['username'])
+            self.users.add(response_json)
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -990,20 +2871,15 @@ class FolioCommunication:
             return None
 
     def deleteUser(self, user_to_delete):
-        logging.info('Försöker ta bort följande användare: ' +
+        logging.info('Försöker ta bort följande användare: %s',
                      user_to_delete)
         path = '/users/' + user_to_delete
         url = self.folio_endpoint + path
 
-        header = {'Content-Type': 'application/json',
-                  'Accept': 'text/plain',
-                  'x-okapi-tenant': self.okapi_tenant,
-                  'X-Okapi-Token': self.okapi_token}
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
+            self.users.invalidate(user_to_delete)
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1020,13 +2896,15 @@ class FolioCommunication:
         url = self.folio_endpoint + path
 
         try:
-            response = requests.post(
-                url, headers=self.header, json=users)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('POST',
+                url, headers=self.header, data=_dumps(users))
+            for user in users.get('users', []):
+                self.users.invalidate(username=user.get('username'))
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
+            logging.info('Systemet säger %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1041,12 +2919,11 @@ class FolioCommunication:
         param = {'limit': 1000}
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1061,12 +2938,11 @@ class FolioCommunication:
         param = {'query': query_string, 'limit': limit}
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header, params=param)
+            response = self._request('GET', url, headers=self.header, params=param)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1075,17 +2951,21 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def iterHoldingsStorage(self, query_string='cql.allRecords=1', page_size=100):
+        """Yields every holdings record matching a CQL query string, one record at a time."""
+        return self.iterData('/holdings-storage/holdings', query_string,
+                             'holdingsRecords', page_size)
+
     def getHoldings(self, holdingId):
         path = '/holdings-storage/holdings/' + holdingId 
         url = self.folio_endpoint + path
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header)
+            response = self._request('GET', url, headers=self.header)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1100,13 +2980,12 @@ class FolioCommunication:
         path = '/holdings-storage/holdings/' + holdingsId
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.put(
-                url, data=json.dumps(holdingsData), headers=self.header)
-            logging.error('Systemet säger %s', response.content)
+            response = self._request('PUT',
+                url, data=_dumps(holdingsData), headers=self.headers['text'])
+            logging.info('Systemet säger %s', response.status_code)
+            if not response.ok:
+                logging.error('Systemet säger %s', self._logged(response.content))
             return response
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1116,19 +2995,15 @@ class FolioCommunication:
             return None
 
     def deleteHoldingsRecord(self, uuid):
-        logging.info('Försöker ta bort följande holdings: ' +
+        logging.info('Försöker ta bort följande holdings: %s',
                      uuid)
         path = '/holdings-storage/holdings/' + uuid
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=local_header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response.content)
+            logging.info('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1144,9 +3019,9 @@ class FolioCommunication:
 
         try:
 
-            response = requests.post(
+            response = self._request('POST',
                 url, data=holdingsRecord, headers=self.header)
-            logging.info('Systemet säger %s', response.content)
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
             
             logging.info('Systemet säger %s', response.status_code)
@@ -1165,12 +3040,11 @@ class FolioCommunication:
         
         path = '/item-storage/batch/synchronous'
         url = self.folio_endpoint + path
-        header = self.header
 
         try:
-            response = requests.post(
-                url, headers=header, data=items)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('POST',
+                url, headers=self.header, data=items)
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
             
             logging.info('Systemet säger %s', response.status_code)
@@ -1185,63 +3059,110 @@ class FolioCommunication:
             return None
 
 
-    def getUserId(self, username):
-
-        path = '/users?limit=1&query=(username=' + username + ')'
-        url = self.folio_endpoint + path
-
-        header = {'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'x-okapi-tenant': self.okapi_tenant,
-                    'x-okapi-token': self.okapiToken}
-
+    def _batches(self, records, max_records, max_bytes):
+        """Serializes records one at a time and yields lists of (record, UTF-8 JSON) no larger than max_records records or max_bytes bytes."""
+        batch = []
+        size = 0
+        for record in records:
+            text = _dumps(record)
+            if batch and (len(batch) >= max_records or size + len(text) > max_bytes):
+                yield batch
+                batch = []
+                size = 0
+            batch.append((record, text))
+            size += len(text) + 1
+        if batch:
+            yield batch
+
+    # Statuses meaning that records in the batch were rejected, as opposed to the server failing
+    REJECTED = {400, 422}
+
+    def _loadBatch(self, path, key, batch, params, report):
+        """Posts a batch and, if its records are rejected, splits it in two and posts the halves until the bad records are isolated."""
+        body = b'{"' + key.encode() + b'":[' + b','.join(text for record, text in batch) + b']}'
+        # An upsert can safely be sent again, a plain insert can not
+        retry = True if params else None
         try:
-            response = requests.get(
-                url, headers=header)
-            logging.info('Systemet säger %s', response.content)
-            response.raise_for_status()
-            response_json = response.json()
-            logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
-
-
-            if response_json['resultInfo']['totalRecords'] == 0:
-                userId = ""
-            else:
-                userId = response_json['users'][0]['id']
-
-            return userId
+            response = self._request('POST', self.folio_endpoint + path, data=body,
+                                     headers=self.header, params=params, retry=retry)
+            status, message = response.status_code, response.text
+        except Exception as err:
+            status, message = None, str(err)
+
+        if status is not None and status < 300:
+            report.add(committed=len(batch))
+            return
+        if status not in self.REJECTED:
+            # Splitting would only send more requests to a failing server
+            logging.error('Batch med %s poster kunde inte sparas (%s): %s',
+                          len(batch), status, self._logged(message))
+            report.add(failed=[(record, status, message) for record, text in batch])
+            return
+        if len(batch) == 1:
+            logging.error('Post kunde inte sparas (%s): %s', status, self._logged(message))
+            report.add(failed=[(batch[0][0], status, message)])
+            return
+
+        report.add()
+        logging.info('Batch med %s poster avvisades (%s), delar upp den.', len(batch), status)
+        middle = len(batch) // 2
+        self._loadBatch(path, key, batch[:middle], params, report)
+        self._loadBatch(path, key, batch[middle:], params, report)
+
+    def _batchLoad(self, path, key, records, max_records, max_bytes, workers, upsert):
+        report = BatchReport(key)
+        params = {'upsert': 'true'} if upsert else None
+        logging.info('Laddar %s i batcher om högst %s poster.', key, max_records)
+
+        def load(batch):
+            self._loadBatch(path, key, batch, params, report)
+
+        for batch, result in _run_bounded(load, self._batches(records, max_records, max_bytes), workers):
+            logging.debug('Batchladdning: %s', report)
+
+        logging.info('Batchladdning klar: %s', report)
+        return report
+
+    def loadItems(self, items, max_records=1000, max_bytes=8000000, workers=4, upsert=False):
+        """Stores item dicts from any iterable through /item-storage/batch/synchronous in concurrent batches. Returns a BatchReport."""
+        return self._batchLoad('/item-storage/batch/synchronous', 'items', items,
+                               max_records, max_bytes, workers, upsert)
+
+    def loadHoldings(self, holdings, max_records=1000, max_bytes=8000000, workers=4, upsert=False):
+        """Stores holdings dicts from any iterable through /holdings-storage/batch/synchronous, in the same way as loadItems. Returns a BatchReport."""
+        return self._batchLoad('/holdings-storage/batch/synchronous', 'holdingsRecords', holdings,
+                               max_records, max_bytes, workers, upsert)
 
+    def getUserId(self, username):
+        """Returns the UUID of the user with the username, or "" if there is none. Looks in self.users first."""
+        try:
+            return self.users.uuid('username', username) or ""
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
-            return response.status_code
+            return http_err.response.status_code
         except Exception as err:
             logging.error(f'Other error occurred: {err}')
-            return None
-
-    def addNewPermissions(self, userId):
 
+    def addNewPermissions(self, userId, permissions=None):
+        """Creates the permission user of a user UUID with the given permission names, by default the ones patrons need."""
         path = '/perms/users'  
 
+        if permissions is None:
+            permissions = ['patron.all','users.collection.get','circulation.requests.item.get']
         jsondata = {'userId': userId,
-                    'permissions': ['patron.all','users.collection.get','circulation.requests.item.get']
+                    'permissions': permissions
                      }
 
         url = self.folio_endpoint + path
 
-        header = {'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'x-okapi-tenant': self.okapi_tenant,
-                    'x-okapi-token': self.okapiToken}
-
         try:
-            response = requests.post(
-                url, headers=header, json=jsondata)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('POST',
+                url, headers=self.header, data=_dumps(jsondata))
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
+            logging.info('Systemet säger %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1261,19 +3182,14 @@ class FolioCommunication:
 
         url = self.folio_endpoint + path
 
-        header = {'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'x-okapi-tenant': self.okapi_tenant,
-                    'x-okapi-token': self.okapiToken}
-
         try:
-            response = requests.put(
-                url, headers=header, json=jsondata)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('PUT',
+                url, headers=self.header, data=_dumps(jsondata))
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
+            logging.info('Systemet säger %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1283,59 +3199,85 @@ class FolioCommunication:
             return None
 
 
-    def getPermissionsId(self, userId):
-
-        path = '/perms/users?query=userId=' + userId
-        url = self.folio_endpoint + path
-
-        header = {'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'x-okapi-tenant': self.okapi_tenant,
-                    'x-okapi-token': self.okapiToken}
-
-        try:
-            response = requests.get(
-                url, headers=header)
-            logging.info('Systemet säger %s', response.content)
-            response.raise_for_status()
-            response_json = response.json()
-            logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
-
-
-            if response_json['resultInfo']['totalRecords'] == 0:
-                result = ""
+    def getPermissionUsers(self, userIds, workers=4):
+        """Returns the permission users of many user UUIDs as a dict from user UUID to record. Raises HTTPError if a query fails."""
+        def fetch(query):
+            return list(self.iterData('/perms/users', query, 'permissionUsers', page_size=1000))
+
+        permission_users = {}
+        for query, records in _run_bounded(fetch, _cql_chunks('userId', sorted(set(userIds))), workers):
+            for record in records:
+                permission_users[record['userId']] = record
+        return permission_users
+
+    def syncPermissions(self, desired, remove_others=True, workers=4):
+        """Gives many users the desired permissions, writing only to users whose permissions differ. Returns a PermissionSyncReport."""
+        report = PermissionSyncReport()
+        desired = {userId: list(dict.fromkeys(names)) for userId, names in desired.items()}
+        current = self.getPermissionUsers(desired, workers)
+        logging.info('Synkar behörigheter för %s användare, %s har behörighetsanvändare',
+                     len(desired), len(current))
+
+        writes = []
+        for userId, names in desired.items():
+            record = current.get(userId)
+            if record is None:
+                writes.append((userId, None, names))
+                report.changes[userId] = (names, [])
+                continue
+            existing = record.get('permissions', [])
+            wanted = set(names)
+            # Keep the existing order and append what is new
+            target = [name for name in existing if name in wanted or not remove_others]
+            target += [name for name in names if name not in set(existing)]
+            if set(target) == set(existing):
+                report.unchanged.append(userId)
+                continue
+            writes.append((userId, record['id'], target))
+            report.changes[userId] = ([name for name in target if name not in set(existing)],
+                                      [name for name in existing if name not in set(target)])
+
+        def write(task):
+            userId, permissionsId, permissions = task
+            if permissionsId is None:
+                return self.addNewPermissions(userId, permissions)
+            return self.setExistingPermissions(permissionsId, userId, permissions)
+
+        for (userId, permissionsId, permissions), result in _run_bounded(write, writes, workers):
+            if not isinstance(result, dict):
+                report.failed[userId] = result
+            elif permissionsId is None:
+                report.created.append(userId)
             else:
-                result = response_json['permissionUsers'][0]['id']
+                report.updated.append(userId)
 
-            return result
+        logging.info('Behörighetssynk klar: %s', report)
+        return report
 
+    def getPermissionsId(self, userId):
+        """Returns the id of the permission user of a user UUID, or "" if there is none. Looks in self.users first."""
+        try:
+            return self.users.permissionsId(userId) or ""
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
-            return response.status_code
+            return http_err.response.status_code
         except Exception as err:
             logging.error(f'Other error occurred: {err}')
             return None
 
-
     def PIN_Exists(self, userId):
     
         path = '/authn/credentials-existence?userId=' + userId
         url = self.folio_endpoint + path
 
-        header = {'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'x-okapi-tenant': self.okapi_tenant,
-                    'x-okapi-token': self.okapiToken}
-
         try:
-            response = requests.get(
-                url, headers=header)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('GET',
+                url, headers=self.header)
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response_json)
+            logging.info('Systemet säger %s', self._logged(response_json))
 
             result = response_json['credentialsExist']
 
@@ -1355,15 +3297,10 @@ class FolioCommunication:
         path = '/authn/credentials?userId=' + userId
         url = self.folio_endpoint + path
 
-        header = {'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'x-okapi-tenant': self.okapi_tenant,
-                    'x-okapi-token': self.okapiToken}
-
         try:
-            response = requests.delete(
-                url, headers=header)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('DELETE',
+                url, headers=self.header)
+            logging.info('Systemet säger %s', self._logged(response.content))
             response.raise_for_status()
     
             logging.info('Systemet säger %s', response.status_code)
@@ -1388,15 +3325,10 @@ class FolioCommunication:
 
         url = self.folio_endpoint + path
 
-        header = {'Accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'x-okapi-tenant': self.okapi_tenant,
-                    'x-okapi-token': self.okapiToken}
-
         try:
-            response = requests.post(
-                url, headers=header, json=jsondata)
-            logging.info('Systemet säger %s', response.content)
+            response = self._request('POST',
+                url, headers=self.header, data=_dumps(jsondata))
+            # Only the status is logged, since an error body may echo the PIN
             response.raise_for_status()
             
             logging.info('Systemet säger %s', response.status_code)
@@ -1410,20 +3342,46 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def setPINs(self, pins, replace=True, workers=4):
+        """Sets PINs for many users from a dict or (user UUID, PIN) pairs, replacing existing ones only if replace is on. Returns a PinReport."""
+        if isinstance(pins, dict):
+            pins = pins.items()
+
+        def provision(pair):
+            userId, pin = pair
+            exists = self.PIN_Exists(userId)
+            if exists is not True and exists is not False:
+                return None, ('check', exists)
+            if exists:
+                if not replace:
+                    return 'kept', None
+                removed = self.removePIN(userId)
+                if not hasattr(removed, 'status_code'):
+                    return None, ('remove', removed)
+            result = self.setPIN(userId, pin)
+            if not hasattr(result, 'status_code'):
+                return None, ('set', result)
+            return ('replaced' if exists else 'set'), None
+
+        report = PinReport()
+        for (userId, pin), (outcome, failure) in _run_bounded(provision, pins, workers):
+            if failure is not None:
+                report.failed[userId] = failure
+            else:
+                getattr(report, outcome).append(userId)
+        logging.info('PIN-koder klara: %s', report)
+        return report
+
     def deleteServicePoint(self, uuid):
-        logging.info('Försöker ta bort följande service point: ' +
+        logging.info('Försöker ta bort följande service point: %s',
                      uuid)
         path = '/service-points/' + uuid
         url = self.folio_endpoint + path
 
-        local_header = self.header
-        local_header['Accept'] = 'text/plain'
-
         try:
-            response = requests.delete(url, data=json.dumps(
-                self.payload), headers=local_header)
+            response = self._request('DELETE', url, headers=self.headers['text'])
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Systemet säger %s', response.content)
+            logging.info('Systemet säger %s', self._logged(response.content))
             return response.status_code
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1437,12 +3395,11 @@ class FolioCommunication:
         url = self.folio_endpoint + path
 
         try:
-            response = requests.get(url, data=json.dumps(
-                self.payload), headers=self.header)
+            response = self._request('GET', url, headers=self.header)
             response.raise_for_status()
-            response_json = response.json()
+            response_json = _loads(response.content)
             logging.info('Systemet säger %s', response.status_code)
-            logging.info('Hittade: %s', response_json)
+            logging.info('Hittade: %s', self._logged(response_json))
             return response_json
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
@@ -1451,35 +3408,226 @@ class FolioCommunication:
             logging.error(f'Other error occurred: {err}')
             return None
 
+    def lookup(self, record_type, field, values, workers=4):
+        """Finds the records whose field matches any of values with a few concurrent CQL queries. Returns a dict from value to record and the set of values not found."""
+        path, key = self.LOOKUP_TYPES[record_type]
+        wanted = {str(value): value for value in values}
+        # CQL == usually ignores case, so fall back to a case-insensitive match
+        folded = {text.casefold(): value for text, value in wanted.items()}
+        found = {}
+
+        def fetch(query):
+            return list(self.iterData(path, query, key, page_size=1000))
+
+        queries = _cql_chunks(field, sorted(wanted))
+        for query, records in _run_bounded(fetch, queries, workers):
+            for record in records:
+                match = record.get(field)
+                if match is None:
+                    continue
+                value = wanted.get(str(match), folded.get(str(match).casefold()))
+                if value is not None and value not in found:
+                    found[value] = record
+        missing = set(wanted.values()) - set(found)
+        logging.info('Slog upp %s %s på %s: %s hittade, %s saknas',
+                     len(wanted), record_type, field, len(found), len(missing))
+        return found, missing
+
+    def getInstancesByIds(self, uuids, workers=4):
+        """Returns (found, missing) for a list of instance UUIDs, see lookup."""
+        return self.lookup('instances', 'id', uuids, workers)
+
+    def getHoldingsByIds(self, uuids, workers=4):
+        """Returns (found, missing) for a list of holdings record UUIDs, see lookup."""
+        return self.lookup('holdings', 'id', uuids, workers)
+
+    def getItemsByIds(self, uuids, workers=4):
+        """Returns (found, missing) for a list of item UUIDs, see lookup."""
+        return self.lookup('items', 'id', uuids, workers)
+
+    def getItemsByBarcodes(self, barcodes, workers=4):
+        """Returns (found, missing) for a list of item barcodes, see lookup."""
+        return self.lookup('items', 'barcode', barcodes, workers)
+
+    def getUsersByIds(self, uuids, workers=4):
+        """Returns (found, missing) for a list of user UUIDs, see lookup."""
+        return self.lookup('users', 'id', uuids, workers)
+
+    def getUsersByUsernames(self, usernames, workers=4):
+        """Returns (found, missing) for a list of usernames, see lookup."""
+        return self.lookup('users', 'username', usernames, workers)
+
+    def getUsersByBarcodes(self, barcodes, workers=4):
+        """Returns (found, missing) for a list of user barcodes, see lookup."""
+        return self.lookup('users', 'barcode', barcodes, workers)
+
+    def bulkDelete(self, record_type, uuids, workers=8):
+        """Deletes every UUID in uuids with at most workers deletes at once. record_type is one of the keys of DELETE_METHODS. Returns a DeleteReport."""
+        delete = getattr(self, self.DELETE_METHODS[record_type])
+        report = DeleteReport(record_type)
+        logging.info('Tar bort %s med %s parallella anrop.', record_type, workers)
+
+        for uuid, status in _run_bounded(delete, uuids, workers):
+            report.add(uuid, status)
+
+        logging.info('Borttagning klar: %s', report)
+        return report
+
+    def _sourceRecordIds(self, instance_ids):
+        """Returns the SRS record ids of a batch of instances in one request."""
+        url = self.folio_endpoint + '/source-storage/source-records'
+        response = self._request('POST', url, data=_dumps(list(instance_ids)), retry=True,
+                                 headers=self.header, params={'idType': 'INSTANCE', 'limit': len(instance_ids)})
+        response.raise_for_status()
+        return [record['recordId'] for record in _loads(response.content)['sourceRecords']]
+
+    def planInstanceDelete(self, instance_ids, workers=4, srs_batch_size=500):
+        """Finds the holdings, items, relationships, titles and SRS records referring to the given instances. Returns a DeletePlan."""
+        plan = DeletePlan(instance_ids)
+        instance_ids = sorted(plan.records['instances'])
+        logging.info('Planerar borttagning av %s instanser.', len(instance_ids))
+
+        def lookup(task):
+            record_type, path, key, query = task
+            if record_type == 'srs':
+                return self._sourceRecordIds(query)
+            return [record['id'] for record in self.iterData(path, query, key, page_size=1000)]
+
+        tasks = []
+        for query in _cql_chunks('instanceId', instance_ids):
+            tasks.append(('holdings', '/holdings-storage/holdings', 'holdingsRecords', query))
+        for query in _cql_chunks(('subInstanceId', 'superInstanceId'), instance_ids):
+            tasks.append(('instanceRelationships', '/instance-storage/instance-relationships',
+                          'instanceRelationships', query))
+        for query in _cql_chunks(('precedingInstanceId', 'succeedingInstanceId'), instance_ids):
+            tasks.append(('precedingSucceedingTitles', '/preceding-succeeding-titles',
+                          'precedingSucceedingTitles', query))
+        for start in range(0, len(instance_ids), srs_batch_size):
+            tasks.append(('srs', None, None, instance_ids[start:start + srs_batch_size]))
+
+        for task, ids in _run_bounded(lookup, tasks, workers):
+            plan.records[task[0]].update(ids)
+
+        # Items are found through the holdings found above
+        tasks = [('items', '/item-storage/items', 'items', query)
+                 for query in _cql_chunks('holdingsRecordId', sorted(plan.records['holdings']))]
+        for task, ids in _run_bounded(lookup, tasks, workers):
+            plan.records['items'].update(ids)
+
+        logging.info('Borttagningsplan: %s', plan)
+        return plan
+
+    def executeDeletePlan(self, plan, workers=8):
+        """Deletes the records in a DeletePlan level by level, with the deletes within a level running in parallel. Returns a DeleteReport per record type."""
+        reports = {}
+
+        def delete(pair):
+            record_type, uuid = pair
+            return getattr(self, self.DELETE_METHODS[record_type])(uuid)
+
+        for level in plan.levels():
+            pairs = [(record_type, uuid) for record_type, ids in level for uuid in ids]
+            for record_type, ids in level:
+                reports[record_type] = DeleteReport(record_type)
+            for (record_type, uuid), status in _run_bounded(delete, pairs, workers):
+                reports[record_type].add(uuid, status)
+            for record_type, ids in level:
+                logging.info('Borttagning klar: %s', reports[record_type])
+
+        return reports
+
+    def deleteInstanceTrees(self, instance_ids, workers=8):
+        """Deletes instances together with everything that refers to them. Returns a DeleteReport per record type."""
+        return self.executeDeletePlan(self.planInstanceDelete(instance_ids), workers)
+
+
+class _AsyncService:
+    """Wraps a helper such as folio.jobs so that its methods run on the worker threads of an AsyncFolioCommunication."""
+
+    def __init__(self, client, service):
+        self._client = client
+        self._service = service
+
+    def __getattr__(self, name):
+        attribute = getattr(self._service, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        return self._client._wrap(name, attribute)
+
+
+class AsyncFolioCommunication:
+    """Asyncio counterpart to FolioCommunication. Every public method is a coroutine and the iter* methods are async generators, run on worker threads."""
+
+    def __init__(self, max_concurrency=20, folio=None, **kwargs):
+        # The pool must hold a connection per worker or connections are discarded
+        kwargs.setdefault('pool_maxsize', max_concurrency)
+        self.folio = folio if folio is not None else FolioCommunication(**kwargs)
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                            thread_name_prefix='folio')
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stops the worker threads and closes the pooled connections."""
+        self._executor.shutdown(wait=True)
+        self.folio.close()
+
+    async def _run(self, func, *args, **kwargs):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs))
+
+    # Helpers on the client that make requests, and so are wrapped like its methods
+    SERVICES = {'jobs', 'sync', 'users', 'reference', 'tokens'}
+
+    def _wrap(self, name, attribute):
+        if name.startswith('iter') or inspect.isgeneratorfunction(attribute):
+            async def iterate(*args, **kwargs):
+                records = await self._run(attribute, *args, **kwargs)
+                done = object()
+                while True:
+                    record = await self._run(next, records, done)
+                    if record is done:
+                        return
+                    yield record
+            return iterate
+
+        async def call(*args, **kwargs):
+            return await self._run(attribute, *args, **kwargs)
+        return call
+
+    def __getattr__(self, name):
+        attribute = getattr(self.folio, name)
+        if name in self.SERVICES:
+            return _AsyncService(self, attribute)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        return self._wrap(name, attribute)
+
+    async def map(self, name, arguments):
+        """Calls the named method once per entry in arguments, concurrently within the concurrency ceiling, and returns the results in the same order. An entry that is not a tuple is passed as the only argument."""
+        method = getattr(self, name)
+        return await asyncio.gather(*(
+            method(*(args if isinstance(args, tuple) else (args,)))
+            for args in arguments))
+
+
+LIBRIS_JOB_PROFILE = {'id': 'aa8ff044-2490-4611-ac74-3054aa21e8eb',
+                      'name': 'Libris',
+                      'dataType': 'MARC'}
 
 
 def demo_libris_import(folio):
-    for filename in os.listdir("../libris_files/"):
-        if filename.endswith(".mrc"):
-            if os.stat("../libris_files/" + filename).st_size != 0:
-
-                stage1_result = folio.uploadDefinitions(filename)
-                print("STAGE 1:", stage1_result)
-                uploadDefinitionId = stage1_result['id']
-                fileDefinitionId = stage1_result['fileDefinitions'][0]['id']
-
-                with open("../libris_files/" + filename, 'rb') as f:
-                    data = f.read()
-
-                stage2_result = folio.uploadFile(
-                    uploadDefinitionId, fileDefinitionId, data)
-                print("STAGE 2", stage2_result)
-
-                stage2_string = json.dumps(stage2_result)
-                stage2_string = stage2_string.replace("'", '"')
-
-                data = '{"uploadDefinition":' + stage2_string + \
-                    ', "jobProfileInfo": {"id": "aa8ff044-2490-4611-ac74-3054aa21e8eb", "name": "Libris", "dataType": "MARC"}}'
-                data_json = json.loads(data)
-
-                stage3_result = folio.processFile(
-                    uploadDefinitionId, data_json)
-                print("STAGE 3:", stage3_result)
+    results = folio.importMarcDirectory("../libris_files/", LIBRIS_JOB_PROFILE)
+    for filename, result in results.items():
+        print(filename, result)
 
 
 def demo_update_mapping_rules(folio):
@@ -1502,6 +3650,14 @@ if __name__ == '__main__':
     logging.info('Startar en Folio-session.')
     folio = FolioCommunication()
 
+    # with FolioCommunication(pool_maxsize=20) as folio:
+    #     folio.getInstances('title="interesting*"')
+
+    # async def lookup(barcodes):
+    #     async with AsyncFolioCommunication(max_concurrency=20) as afolio:
+    #         return await afolio.map('getItems', ('barcode==' + b for b in barcodes))
+    # asyncio.run(lookup(['30012345', '30012346']))
+
     # folio.deleteServicePoint('01402059-bdcd-4f5e-a6ae-285cfe2730ac')
     # folio.deleteServicePoint('06239465-2997-447f-b9c8-5ecfb4f6ddf4')
     # folio.deleteServicePoint('9c8d405b-5ee7-4b56-bf92-a4a3063ae114')
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from FolioCommunication import _iter_json_array
+
+
+def split_everywhere(document):
+    """Yields the document as two chunks for every possible cut, and as single bytes."""
+    for cut in range(len(document) + 1):
+        yield [document[:cut], document[cut:]]
+    yield [document[i:i + 1] for i in range(len(document))]
+
+
+def check(document, key, expected):
+    raw = json.dumps(document, ensure_ascii=False).encode('utf-8')
+    for chunks in split_everywhere(raw):
+        assert list(_iter_json_array(chunks, key)) == expected
+
+
+def test_records():
+    check({'totalRecords': 2, 'items': [{'id': 'a'}, {'id': 'b'}]}, 'items',
+          [{'id': 'a'}, {'id': 'b'}])
+
+
+def test_empty_array():
+    check({'items': [], 'totalRecords': 0}, 'items', [])
+
+
+def test_missing_key():
+    check({'other': [1, 2]}, 'items', [])
+
+
+def test_decoy_key_in_nested_object():
+    document = {'resultInfo': {'items': [{'id': 'decoy'}]}, '"items': [0],
+                'items': [{'id': 'real'}], 'after': {'items': [1]}}
+    check(document, 'items', [{'id': 'real'}])
+
+
+def test_strings_with_brackets_and_escapes():
+    records = [{'title': 'a ] b [ } {', 'note': 'quote " and \\ backslash'}, ']', '\\']
+    check({'items': records}, 'items', records)
+
+
+def test_numbers_cut_across_chunks():
+    records = [1, 22, 333, -4.5e10, 0.125, True, False, None]
+    check({'items': records}, 'items', records)
+
+
+def test_multibyte_utf8():
+    records = [{'title': 'Åäö på svenska'}, '€', '𝄞 musik']
+    check({'items': records}, 'items', records)
+
+
+def test_truncated_document_raises():
+    with pytest.raises(ValueError):
+        list(_iter_json_array([b'{"items": [1, 2'], 'items'))